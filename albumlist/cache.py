@@ -0,0 +1,382 @@
+import collections
+import gzip
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+
+import flask
+import redis
+
+from albumlist import versions
+from albumlist.delayed import redis_connection
+from albumlist.models import use_primary
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serialize to JSON bytes with sorted keys (as flask.jsonify does), using
+    orjson where it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+
+# delete the lock only if it is still ours, and not one taken after ours expired
+RELEASE_LOCK = redis_connection.register_script("""
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """)
+
+
+def single_flight(key, lookup, build, stale=None, lock_timeout=30.0, wait=3.0, interval=0.05):
+    """
+    Rebuild a missing cache value in only one place at a time. The caller
+    that takes the `lock:<key>` lock in Redis calls build() (which should
+    store the value); the others return stale() if it has anything, or
+    else poll lookup() for up to `wait` seconds before building it anyway.
+    """
+    lock = f'lock:{key}'
+    token = uuid.uuid4().hex
+    if redis_connection.set(lock, token, nx=True, px=int(lock_timeout * 1000)):
+        try:
+            return build()
+        finally:
+            RELEASE_LOCK(keys=[lock], args=[token])
+    value = stale() if stale else None
+    if value is not None:
+        return value
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(interval)
+        value = lookup()
+        if value is not None:
+            return value
+    return build()
+
+
+class LocalCache:
+    """
+    A per-process LRU in front of Redis, bounded by entry count and by the
+    (pickled) size of its values. Entries are keyed by unversioned base key
+    and dropped after `ttl` seconds, or as soon as a version bump for one of
+    their scopes arrives over pub/sub, so a hit never leaves the process.
+    Each keeps the versions tag it was stored at, for callers that already
+    know the current one to check against.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=32 * 2 ** 20, ttl=60.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.subscribed = False
+        self._entries = collections.OrderedDict()
+        self._by_scope = collections.defaultdict(set)
+        self._bytes = 0
+        self._seq = 0
+        # recent invalidations as (seq, scopes), to refuse fills that raced them
+        self._recent = collections.deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def get(self, key):
+        """
+        Return (value, tag) for a live entry, or None.
+        """
+        self._listen()
+        with self._lock:
+            entry = self._entries.get(key) if self.subscribed else None
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[4]
+
+    def mark(self):
+        """
+        Return a marker to pass to set(), taken before reading the value.
+        """
+        return self._seq
+
+    def set(self, key, value, scopes, since, tag):
+        size = len(value) if isinstance(value, bytes) else len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            if not self.subscribed or self._invalidated_since(since, scopes):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, scopes, size, tag)
+            for scope in scopes:
+                self._by_scope[scope].add(key)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _invalidated_since(self, since, scopes):
+        if self._recent and self._recent[0][0] > since + 1:
+            # older invalidations have been forgotten, so assume the worst
+            return True
+        return any(seq > since and ('*' in invalidated or invalidated.intersection(scopes))
+                   for seq, invalidated in self._recent)
+
+    def _remove(self, key):
+        _, _, scopes, size, _ = self._entries.pop(key)
+        self._bytes -= size
+        for scope in scopes:
+            keys = self._by_scope[scope]
+            keys.discard(key)
+            if not keys:
+                del self._by_scope[scope]
+
+    def invalidate(self, scopes):
+        scopes = set(scopes)
+        with self._lock:
+            self._seq += 1
+            self._recent.append((self._seq, scopes))
+            if '*' in scopes:
+                keys = list(self._entries)
+            else:
+                keys = set().union(*(self._by_scope.get(scope, ()) for scope in scopes))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidate(['*'])
+
+    def _listen(self):
+        # threads don't survive a fork, so each gunicorn worker subscribes for itself
+        if self._listener is None or self._listener.pid != os.getpid():
+            with _listener_lock:
+                if self._listener is None or self._listener.pid != os.getpid():
+                    self._lock = threading.Lock()
+                    self.subscribed = False
+                    self.clear()
+                    self._listener = threading.Thread(target=self._subscribe, name='local-cache', daemon=True)
+                    self._listener.pid = os.getpid()
+                    self._listener.start()
+
+    def _subscribe(self):
+        while True:
+            pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(versions.INVALIDATIONS_CHANNEL)
+                # anything cached before now may have missed its invalidation
+                self.clear()
+                self.subscribed = True
+                for message in pubsub.listen():
+                    self.invalidate(json.loads(message['data']))
+            except (redis.RedisError, ValueError) as e:
+                print(f'[cache]: lost invalidations subscription: {e}')
+            finally:
+                self.subscribed = False
+                pubsub.close()
+            time.sleep(1)
+
+    def get_stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'subscribed': self.subscribed,
+        }
+
+
+_listener_lock = threading.Lock()
+
+local_cache = LocalCache(
+    max_entries=int(os.environ.get('LOCAL_CACHE_ENTRIES', 1000)),
+    max_bytes=int(os.environ.get('LOCAL_CACHE_BYTES', 32 * 2 ** 20)),
+    ttl=float(os.environ.get('LOCAL_CACHE_TTL', 60)),
+)
+
+
+def cached(cache, base, build, scopes=(), timeout=versions.VERSIONED_TTL):
+    """
+    Get a value from the local tier, or from the (flask) cache, where
+    `<base>@v` holds the last value built along with the versions of
+    `scopes` it was built at. If those are out of date, build it again from
+    the primary with single_flight, serving the old value meanwhile. Old
+    values are reported with versions.served_stale, as are local hits that
+    can't be checked against the request's ETag.
+    """
+    request_tag = versions.request_etag(scopes)
+    hit = local_cache.get(base)
+    if hit is not None and request_tag in (None, hit[1]):
+        if request_tag is None:
+            versions.served_stale(scopes, None)
+        return hit[0]
+    since = local_cache.mark()
+    tag = request_tag or versions.etag(*scopes)
+    key = f'{base}@v'
+    entry = cache.get(key)
+    if entry is not None and entry[0] == tag:
+        local_cache.set(base, entry[1], scopes, since, tag)
+        return entry[1]
+
+    def lookup():
+        latest = cache.get(key)
+        return latest[1] if latest is not None and latest[0] == tag else None
+
+    def fill():
+        with use_primary():
+            value = build()
+        cache.set(key, (tag, value), timeout)
+        return value
+
+    def stale():
+        if entry is None:
+            return None
+        versions.served_stale(scopes, entry[0])
+        return entry[1]
+
+    return single_flight(f'{key}@{tag}', lookup, fill, stale=stale)
+
+
+class ResponseCache:
+    """
+    Caches API responses in Redis as ready-to-send, gzipped JSON bytes, so
+    that a hit is one GET and a write of the body as-is to the client.
+    """
+
+    def __init__(self, redis_connection, prefix='resp:', compresslevel=6):
+        self.redis = redis_connection
+        self.prefix = prefix
+        self.compresslevel = compresslevel
+
+    def key(self, endpoint=None, args=None):
+        """
+        Key a response by endpoint and query parameters, defaulting to those
+        of the current request.
+        """
+        endpoint = endpoint or flask.request.path
+        args = flask.request.args if args is None else args
+        params = '&'.join(f'{name}={value}' for name, value in sorted(args.items(multi=True)))
+        return f'{self.prefix}{endpoint}?{params}'
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, body, timeout):
+        self.redis.set(key, body, ex=timeout)
+
+    def get_versioned(self, key):
+        """
+        Return the (versions tag, body) stored at a versioned key, or (None, None).
+        """
+        value = self.redis.get(key)
+        if value is None:
+            return None, None
+        tag, _, body = value.partition(b' ')
+        return tag.decode(), body
+
+    def set_versioned(self, key, tag, body, timeout):
+        self.redis.set(key, tag.encode() + b' ' + body, ex=timeout)
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*keys)
+
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        elif not isinstance(data, bytes):
+            data = dumps(data)
+        return gzip.compress(data, compresslevel=self.compresslevel)
+
+    @staticmethod
+    def response(body, status=200):
+        """
+        Send a gzipped body as it is to clients that accept gzip, otherwise
+        inflate it first.
+        """
+        response = flask.Response(mimetype='application/json', status=status)
+        if flask.request.accept_encodings['gzip']:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response.set_data(gzip.decompress(body))
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def cached(self, build, timeout=versions.VERSIONED_TTL, key=None, scopes=()):
+        """
+        Return the cached response for `key` (by default the current request),
+        or call build() for a JSON string, bytes or serializable object to
+        cache and send. Misses go through single_flight.
+
+        With `scopes`, the body is stored at `<key>@v` along with the versions
+        of the scopes it was built at, and rebuilt once they have moved on,
+        serving the old body meanwhile; each key is overwritten in place, so
+        bumps leave nothing behind. These rebuilds read from the primary, as
+        a replica may not show the write behind a bump yet. That is one full
+        build on the primary per cached key each time a scope is bumped,
+        which is cheap for narrow scopes such as a tag or an album, but for
+        'albums' means every write rebuilds each catalog-wide response.
+        """
+        base = key or self.key()
+        if not scopes:
+            body = self.get(base)
+            if body is None:
+
+                def fill():
+                    body = self.compress(build())
+                    self.set(base, body, timeout)
+                    return body
+
+                body = single_flight(base, lambda: self.get(base), fill)
+            return self.response(body)
+
+        request_tag = versions.request_etag(scopes)
+        hit = local_cache.get(base)
+        if hit is not None and request_tag in (None, hit[1]):
+            if request_tag is None:
+                versions.served_stale(scopes, None)
+            return self.response(hit[0])
+        since = local_cache.mark()
+        tag = request_tag or versions.etag(*scopes)
+        key = f'{base}@v'
+        stored_tag, body = self.get_versioned(key)
+        if body is not None and stored_tag == tag:
+            local_cache.set(base, body, scopes, since, tag)
+            return self.response(body)
+
+        def lookup():
+            latest_tag, latest = self.get_versioned(key)
+            return latest if latest_tag == tag else None
+
+        def fill():
+            with use_primary():
+                body = self.compress(build())
+            self.set_versioned(key, tag, body, timeout)
+            return body
+
+        def stale():
+            if body is not None:
+                versions.served_stale(scopes, stored_tag)
+            return body
+
+        return self.response(single_flight(f'{key}@{tag}', lookup, fill, stale=stale))
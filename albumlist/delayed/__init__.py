@@ -1,9 +1,19 @@
+import collections
+import functools
+import itertools
+import json
+import math
 import os
 import redis
+import time
 import uuid
 
 from config import Config
-from pickle import loads, dumps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 if 'REDIS_HOST' in os.environ:
@@ -12,6 +22,158 @@ else:
     redis_connection = redis.from_url(os.environ['REDIS_URL'])
 
 
+# bump when the payload layout changes; workers reject versions they don't know
+TASK_FORMAT_VERSION = 1
+
+# queued functions by name, and the functions (e.g. scrapers and model callbacks)
+# that may be passed to them as arguments, which are sent by name too
+tasks = {}
+task_arguments = {}
+_argument_names = {}
+
+
+# queues by priority, each polled by workers in proportion to its weight, so that
+# clicks and link shares don't wait behind thousands of fanned-out maintenance tasks
+LANES = ('interactive', 'ingest', 'maintenance')
+LANE_WEIGHTS = {'interactive': 8, 'ingest': 3, 'maintenance': 1}
+DEFAULT_LANE = 'ingest'
+LANE_QUEUES = {lane: f'{Config.REDIS_QUEUE_KEY}:{lane}' for lane in LANES}
+# the last WAIT_SAMPLES queue wait times of each lane are kept for its metrics
+WAIT_SAMPLES = 1000
+# delay_many sends tasks PUSH_SIZE to an RPUSH, and PUSHES_PER_TRIP RPUSHes to a round trip
+PUSH_SIZE = 500
+PUSHES_PER_TRIP = 10
+
+Task = collections.namedtuple('Task', 'func key args kwargs queued_at')
+
+
+class TaskError(Exception):
+    pass
+
+
+def register_arguments(**functions):
+    """
+    Allow the given functions to be passed to tasks, under these names.
+    """
+    for name, f in functions.items():
+        task_arguments[name] = f
+        _argument_names[f] = name
+
+
+def _check_argument(value):
+    """
+    Raise TypeError unless `value` is made only of plain JSON types, so that
+    a task is sent (or refused) the same with or without orjson, which
+    would otherwise turn e.g. datetimes into strings where json refuses them.
+    """
+    if value is None or isinstance(value, (str, bool)):
+        return
+    if isinstance(value, int):
+        # orjson refuses integers beyond 64 bits
+        if not -2 ** 63 <= value < 2 ** 64:
+            raise TypeError(f'{value} is out of range for a task argument')
+    elif isinstance(value, float):
+        # json would send these as NaN or Infinity, orjson as null
+        if not math.isfinite(value):
+            raise TypeError(f'{value} can not be passed to a task')
+    elif type(value) in (list, tuple):
+        for item in value:
+            _check_argument(item)
+    elif type(value) is dict:
+        if len(value) == 1 and '$fn' in value:
+            raise TypeError('{"$fn": ...} is reserved for registered functions')
+        for name, item in value.items():
+            # json would turn other keys into strings, orjson refuses them
+            if type(name) is not str:
+                raise TypeError(f'task argument keys must be strings, not {name!r}')
+            _check_argument(item)
+    else:
+        raise TypeError(f'{value!r} can not be passed to a task')
+
+
+def _encode_argument(value):
+    if not callable(value):
+        _check_argument(value)
+        return value
+    try:
+        return {'$fn': _argument_names[value]}
+    except KeyError:
+        raise TypeError(f'{value!r} can not be passed to a task')
+
+
+def _decode_argument(value):
+    if type(value) is dict and len(value) == 1 and '$fn' in value:
+        try:
+            return task_arguments[value['$fn']]
+        except KeyError:
+            raise TaskError(f'unknown task argument: {value["$fn"]}')
+    return value
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def result_key(task_id):
+    return f'{Config.REDIS_QUEUE_KEY}:result:{task_id}'
+
+
+def lane_waits_key(lane):
+    return f'{Config.REDIS_QUEUE_KEY}:waits:{lane}'
+
+
+def encode_task(f, task_id, args, kwargs):
+    """
+    Serialize a task call as JSON. Arguments must be JSON types, or (at the
+    top level only) functions registered with register_arguments.
+    """
+    # short field names, as there may be a great many of these waiting in Redis
+    return _dumps({
+        'v': TASK_FORMAT_VERSION,
+        't': f.__name__,
+        'id': task_id,
+        'ts': round(time.time(), 3),
+        'a': [_encode_argument(arg) for arg in args],
+        'k': {name: _encode_argument(arg) for name, arg in kwargs.items()},
+    })
+
+
+def decode_task(data):
+    """
+    Return the Task (function, result key, args, kwargs and when it was
+    queued, if known) of a task payload, raising TaskError for one that is
+    malformed, of an unsupported version, or for a task or argument that
+    isn't registered here.
+    """
+    try:
+        if orjson is not None:
+            payload = orjson.loads(data)
+        else:
+            payload = json.loads(data.decode() if isinstance(data, bytes) else data)
+        version = payload['v']
+    except (ValueError, TypeError, KeyError) as e:
+        raise TaskError(f'malformed task payload: {e}')
+    if version != TASK_FORMAT_VERSION:
+        raise TaskError(f'unsupported task format version: {version}')
+    try:
+        f = tasks[payload['t']]
+        args = [_decode_argument(arg) for arg in payload['a']]
+        kwargs = {name: _decode_argument(arg) for name, arg in payload['k'].items()}
+        return Task(f, result_key(payload['id']), args, kwargs, payload.get('ts'))
+    except (KeyError, AttributeError, TypeError) as e:
+        raise TaskError(f'unknown task or malformed field: {e}')
+
+
+def encode_result(rv):
+    if isinstance(rv, Exception):
+        rv = {'error': str(rv)}
+    if orjson is not None:
+        return orjson.dumps(rv, default=repr)
+    return json.dumps(rv, separators=(',', ':'), default=repr)
+
+
 class DelayedResult(object):
     def __init__(self, key):
         self.key = key
@@ -22,16 +184,107 @@ class DelayedResult(object):
         if self._return_value is None:
             rv = redis_connection.get(self.key)
             if rv is not None:
-                self._return_value = loads(rv)
+                self._return_value = json.loads(rv)
         return self._return_value
 
 
-def queue_func(f):
-    def delay(*args, **kwargs):
-        qkey = Config.REDIS_QUEUE_KEY
-        key = f'{qkey}:result:{uuid.uuid4()}'
-        s = dumps((f, key, args, kwargs))
-        redis_connection.rpush(qkey, s)
-        return DelayedResult(key)
-    f.delay = delay
+def queue_func(f=None, lane=DEFAULT_LANE):
+    """
+    Register a task, to be queued in `lane` by f.delay(*args, **kwargs) or
+    in another lane by f.delay_in(lane, *args, **kwargs), or many times at
+    once by f.delay_many(iterable_of_args). Use either as @queue_func or as
+    @queue_func(lane=...).
+    """
+    if f is None:
+        return functools.partial(queue_func, lane=lane)
+    if lane not in LANE_QUEUES:
+        raise ValueError(f'unknown lane: {lane}')
+    if f.__name__ in tasks:
+        raise ValueError(f'a task named {f.__name__} is already registered')
+    tasks[f.__name__] = f
+
+    def delay_in(lane, *args, **kwargs):
+        task_id = uuid.uuid4().hex
+        redis_connection.rpush(LANE_QUEUES[lane], encode_task(f, task_id, args, kwargs))
+        return DelayedResult(result_key(task_id))
+
+    def delay_many(calls, lane=None):
+        """
+        Queue f(*args) for each args in `calls`, pipelining the pushes, and
+        return how many were queued (without results to wait on).
+        """
+        queue = LANE_QUEUES[lane or f.lane]
+        pipe = redis_connection.pipeline(transaction=False)
+        count = 0
+        for batch in batches((encode_task(f, uuid.uuid4().hex, args, {}) for args in calls), PUSH_SIZE):
+            pipe.rpush(queue, *batch)
+            count += len(batch)
+            if len(pipe) >= PUSHES_PER_TRIP:
+                pipe.execute()
+        pipe.execute()
+        return count
+
+    f.lane = lane
+    f.delay = functools.partial(delay_in, lane)
+    f.delay_in = delay_in
+    f.delay_many = delay_many
+    f.run_async = None
     return f
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def record_wait(lane, waited):
+    """
+    Record how long a task waited in `lane` before a worker took it.
+    """
+    key = lane_waits_key(lane)
+    pipe = redis_connection.pipeline(transaction=False)
+    pipe.lpush(key, round(waited, 3))
+    pipe.ltrim(key, 0, WAIT_SAMPLES - 1)
+    pipe.execute()
+
+
+def get_lane_stats():
+    """
+    Return the depth of each lane and percentiles of its recent wait times.
+    """
+    pipe = redis_connection.pipeline(transaction=False)
+    for lane in LANES:
+        pipe.llen(LANE_QUEUES[lane])
+        pipe.lrange(lane_waits_key(lane), 0, -1)
+    results = pipe.execute()
+    stats = {}
+    for lane, depth, waits in zip(LANES, results[::2], results[1::2]):
+        waits = sorted(float(wait) for wait in waits)
+
+        def percentile(p):
+            return waits[min(int(len(waits) * p), len(waits) - 1)] if waits else None
+
+        stats[lane] = {
+            'depth': depth,
+            'weight': LANE_WEIGHTS[lane],
+            'wait_samples': len(waits),
+            'wait_p50': percentile(0.5),
+            'wait_p95': percentile(0.95),
+            'wait_max': waits[-1] if waits else None,
+        }
+    return stats
+
+
+def async_variant(task):
+    """
+    Register the decorated coroutine function as the implementation of
+    `task` for asyncio workers, which call it with their Fetcher followed
+    by the task's arguments.
+    """
+    def decorator(coro_func):
+        task.run_async = coro_func
+        return coro_func
+    return decorator
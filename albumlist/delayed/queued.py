@@ -1,4 +1,3 @@
-import ast
 import csv
 import io
 import json
@@ -7,14 +6,27 @@ import flask
 import requests
 import slacker
 
-from albumlist import delayed
-from albumlist.models import DatabaseError
+from albumlist import delayed, versions
+from albumlist.models import DatabaseError, use_primary
 from albumlist.models import albums as albums_model, list as list_model
 from albumlist.scrapers import NotFoundError
 from albumlist.scrapers import bandcamp
 from albumlist.views import build_my_list_attachment
 
 
+# albums per batch task, for sweeps over the whole catalog: small enough that a
+# worker busy with one is soon free again for interactive tasks
+BATCH_SIZE = 20
+
+delayed.register_arguments(
+    scrape_bandcamp_album_ids_from_url=bandcamp.scrape_bandcamp_album_ids_from_url,
+    scrape_bandcamp_album_ids_from_url_forced=bandcamp.scrape_bandcamp_album_ids_from_url_forced,
+    scrape_bandcamp_album_ids_from_messages=bandcamp.scrape_bandcamp_album_ids_from_messages,
+    add_to_list=list_model.add_to_list,
+    add_many_to_list=list_model.add_many_to_list,
+)
+
+
 @delayed.queue_func
 def deferred_scrape_channel(scrape_function, callback, channel_id, slack_token, channel_name=None, response_url=None):
     try:
@@ -32,13 +44,12 @@ def deferred_scrape_channel(scrape_function, callback, channel_id, slack_token,
         messages = response.body.get('messages', [])
         if response_url:
             requests.post(response_url, data=json.dumps({'text': f'Scraping {channel_name or channel_id}...'}))
-        album_ids = scrape_function(messages)
-        new_album_ids = list_model.check_for_new_list_ids(album_ids)
+        album_ids = [(album_id,) for album_id in set(scrape_function(messages)) if album_id is not None]
         try:
+            new_album_ids = callback(album_ids) if album_ids else []
             if new_album_ids:
-                callback(new_album_ids)
                 print(f'[scraper]: {len(new_album_ids)} new albums found and added to the list')
-                deferred_process_all_album_details.delay(None)
+                deferred_process_all_album_details.delay_in('ingest', None, incremental=True)
         except DatabaseError as e:
             message = 'failed to update list'
             print(f'[db]: failed to perform {callback.__name__}')
@@ -51,7 +62,7 @@ def deferred_scrape_channel(scrape_function, callback, channel_id, slack_token,
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_consume(url, scrape_function, callback, channel='', tags=None, slack_token=None, response_url=None):
     try:
         album_id = scrape_function(url)
@@ -61,7 +72,7 @@ def deferred_consume(url, scrape_function, callback, channel='', tags=None, slac
         if slack_token:
             slack = slacker.Slacker(slack_token)
         try:
-            if album_id not in list_model.get_list():
+            if not list_model.is_in_list(album_id):
                 try:
                     callback(album_id)
                 except DatabaseError as e:
@@ -94,16 +105,15 @@ def deferred_consume(url, scrape_function, callback, channel='', tags=None, slac
 @delayed.queue_func
 def deferred_consume_artist_albums(artist_url, response_url=None):
     try:
-        existing_albums = list_model.get_list()
         artist_albums = bandcamp.scrape_bandcamp_album_ids_from_artist_page(artist_url)
-        new_album_ids = [album_id for album_id in artist_albums if album_id not in existing_albums]
+        new_album_ids = list_model.add_many_to_list([(album_id,) for album_id in artist_albums])
         if response_url and new_album_ids:
             requests.post(response_url,
                           data=json.dumps({'text': f':full_moon: found {len(new_album_ids)} new albums to process...'}))
         elif response_url:
             requests.post(response_url, data=json.dumps({'text': f':new_moon: found no new albums to process'}))
     except DatabaseError as e:
-        print('[db]: failed to check existing items')
+        print(f'[db]: failed to update list with albums from {artist_url}')
         print(f'[db]: {e}')
     except NotFoundError:
         print(f'[scraper]: no albums found for artist at {artist_url}')
@@ -111,22 +121,17 @@ def deferred_consume_artist_albums(artist_url, response_url=None):
             requests.post(response_url, data=json.dumps({'text': ':red_circle: failed to find any albums'}))
     else:
         for new_album_id in new_album_ids:
-            try:
-                list_model.add_to_list(new_album_id)
-                deferred_process_album_details.delay(str(new_album_id))
-            except DatabaseError as e:
-                print(f'[db]: failed to update list with {new_album_id} from {artist_url}')
-                print(f'[db]: {e}')
+            deferred_process_album_details.delay(str(new_album_id))
         if response_url and new_album_ids:
             requests.post(response_url,
                           data=json.dumps({'text': f':full_moon_with_face: done processing artist albums'}))
 
 
 @delayed.queue_func
-def deferred_process_tags(album_id, tags):
+def deferred_process_tags(album_id, tags, buffered=False):
     tags = [tag[1:].lower() if tag.startswith('#') else tag.lower() for tag in tags]
     try:
-        albums_model.set_album_tags(album_id, tags)
+        albums_model.set_album_tags(album_id, tags, buffered=buffered)
     except DatabaseError as e:
         print(f'[db]: failed to add tags "{tags}" to album {album_id}')
         print(f'[db]: {e}')
@@ -145,13 +150,23 @@ def deferred_process_users(album_id, users):
         print(f'[scraper]: set {album_id} with users "{users}"')
 
 
-@delayed.queue_func
-def deferred_process_all_album_details(response_url=None):
+@delayed.queue_func(lane='maintenance')
+def deferred_process_all_album_details(response_url=None, incremental=False):
+    # albums just found in a channel are ingested, but a full sweep (and everything
+    # it fans out to) stays in maintenance, behind interactive and ingest tasks
+    lane = 'ingest' if incremental else 'maintenance'
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album_id in albums_model.check_for_new_albums():
-            deferred_process_album_details.delay(album_id)
+        since = list_model.get_list_watermark('album_details') if incremental else 0
+        # if the list never settled, check everything since the watermark but leave it where it is
+        until = list_model.get_settled_list_id()
+        deferred_process_album_details.delay_many(
+            ((album_id, '', None, lane) for album_id in albums_model.check_for_new_albums(since, until)), lane=lane)
+        if until is not None:
+            list_model.set_list_watermark('album_details', until)
+        else:
+            print('[db]: list still being written to, album_details watermark not moved')
     except DatabaseError as e:
         print('[db]: failed to check for new album details')
         print(f'[db]: {e}')
@@ -162,18 +177,19 @@ def deferred_process_all_album_details(response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_clear_cache(response_url=None):
     flask.current_app.cache.clear()
+    # moves versioned keys, including the response cache's, on to fresh ones
+    versions.reset()
     if response_url:
         requests.post(response_url, data=json.dumps({'text': 'Cache cleared'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_delete(album_id, response_url=None):
     try:
         albums_model.delete_from_list_and_albums(album_id)
-        flask.current_app.cache.delete(f'alb-{album_id}')
     except DatabaseError as e:
         print(f'[db]: failed to delete album details for {album_id}')
         print(f'[db]: {e}')
@@ -185,7 +201,7 @@ def deferred_delete(album_id, response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_delete_review(album_id, array_element, response_url=None):
     response = {
         'response_type': 'ephemeral',
@@ -203,7 +219,7 @@ def deferred_delete_review(album_id, array_element, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_add_user_to_album(album_url, user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -212,7 +228,9 @@ def deferred_add_user_to_album(album_url, user_id, response_url=None):
         'text': 'Added album to your list.',
     }
     try:
-        album = albums_model.get_album_details_by_url(album_url)
+        # this task re-queues itself behind deferred_consume, so it must see that task's write
+        with use_primary():
+            album = albums_model.get_album_details_by_url(album_url)
         if album:
             albums_model.add_user_to_album(album.album_id, user_id)
         else:
@@ -224,7 +242,6 @@ def deferred_add_user_to_album(album_url, user_id, response_url=None):
             )
             deferred_add_user_to_album.delay(album_url, user_id, response_url=response_url)
             return
-        flask.current_app.cache.delete(f'u-{user_id}')
     except DatabaseError as e:
         response['text'] = 'Failed to add album to your list.'
         print(f'[db]: failed to add user to album')
@@ -235,7 +252,7 @@ def deferred_add_user_to_album(album_url, user_id, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_remove_user_from_album(album_id, user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -244,7 +261,6 @@ def deferred_remove_user_from_album(album_id, user_id, response_url=None):
     }
     try:
         albums_model.remove_user_from_album(album_id, user_id)
-        flask.current_app.cache.delete(f'u-{user_id}')
     except DatabaseError as e:
         response['text'] = 'Failed to remove album from user\'s list'
         print(f'[db]: failed to remove user from album')
@@ -255,7 +271,7 @@ def deferred_remove_user_from_album(album_id, user_id, response_url=None):
         requests.post(response_url, data=json.dumps(response))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_remove_user_from_all_albums(user_id, response_url=None):
     response = {
         'attachments': build_my_list_attachment(),
@@ -264,7 +280,6 @@ def deferred_remove_user_from_all_albums(user_id, response_url=None):
     }
     try:
         albums_model.remove_user_from_all_albums(user_id)
-        flask.current_app.cache.delete(f'u-{user_id}')
     except DatabaseError as e:
         response['text'] = 'Failed to remove all albums from user\'s list'
         print(f'[db]: failed to remove user from all albums')
@@ -276,7 +291,7 @@ def deferred_remove_user_from_all_albums(user_id, response_url=None):
 
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='interactive')
 def deferred_add_review_to_album(album_url, user_id, review, response_url=None):
     response = {
         'replace_original': False,
@@ -284,7 +299,8 @@ def deferred_add_review_to_album(album_url, user_id, review, response_url=None):
         'text': 'Added review to your album.',
     }
     try:
-        album = albums_model.get_album_details_by_url(album_url)
+        with use_primary():
+            album = albums_model.get_album_details_by_url(album_url)
         if album:
             albums_model.add_user_review_to_album(album.album_id, user_id, review)
         else:
@@ -307,13 +323,13 @@ def deferred_add_review_to_album(album_url, user_id, review, response_url=None):
 
 
 @delayed.queue_func
-def deferred_process_album_details(album_id, channel='', slack_token=None):
+def deferred_process_album_details(album_id, channel='', slack_token=None, lane=delayed.DEFAULT_LANE):
     try:
         album, artist, url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
         albums_model.add_to_albums(album_id, artist, album, url, channel=channel)
-        deferred_process_album_cover.delay(album_id)
-        deferred_process_album_tags.delay(album_id)
-        deferred_process_album_released.delay(album_id)
+        deferred_process_album_cover.delay_in(lane, album_id)
+        deferred_process_album_tags.delay_in(lane, album_id)
+        deferred_process_album_released.delay_in(lane, album_id)
     except DatabaseError as e:
         print(f'[db]: failed to add album details for {album_id}')
         print(f'[db]: {e}')
@@ -333,10 +349,10 @@ def deferred_process_album_details(album_id, channel='', slack_token=None):
 
 
 @delayed.queue_func
-def deferred_add_new_album_details(album_object):
+def deferred_add_new_album_details(album_details):
+    album_object = albums_model.Album.from_dict(album_details)
     try:
-        if album_object.album_id not in list_model.get_list():
-            list_model.add_to_list(album_object.album_id)
+        list_model.add_to_list(album_object.album_id)
         if albums_model.get_album_details(album_object.album_id) is None:
             album_object.save()
         if album_object.added:
@@ -344,14 +360,10 @@ def deferred_add_new_album_details(album_object):
         if not album_object.album_image:
             deferred_process_album_cover.delay(album_object.album_id)
         if album_object.tags is not None:
-            if isinstance(album_object.tags, str):
-                album_object.tags = ast.literal_eval(album_object.tags)
             deferred_process_tags.delay(album_object.album_id, album_object.tags)
         else:
             deferred_process_album_tags.delay(album_object.album_id)
         if album_object.users is not None:
-            if isinstance(album_object.users, str):
-                album_object.users = ast.literal_eval(album_object.users)
             deferred_process_users.delay(album_object.album_id, album_object.users)
         deferred_check_album_url.delay(album_object.album_id)
         deferred_process_album_released.delay(album_object.album_id)
@@ -362,12 +374,10 @@ def deferred_add_new_album_details(album_object):
         print(f'[db]: added new album details for [{album_object.album_id}] {album_object.album_name} by {album_object.album_artist}')
 
 
-@delayed.queue_func
-def deferred_process_album_cover(album_id):
+def process_album_cover(album_id, album):
     try:
-        album = albums_model.get_album_details(album_id)
         album_cover_url = bandcamp.scrape_bandcamp_album_cover_url_from_url(album.album_url)
-        albums_model.add_img_to_album(album_id, album_cover_url)
+        albums_model.add_img_to_album(album_id, album_cover_url, buffered=True)
     except DatabaseError as e:
         print(f'[db]: failed to add album cover for {album_id}')
         print(f'[db]: {e}')
@@ -380,32 +390,26 @@ def deferred_process_album_cover(album_id):
         print(f'[scraper]: processed cover for {album_id}')
 
 
-@delayed.queue_func
-def deferred_process_album_tags(album_id):
+def process_album_tags(album_id, album):
     try:
-        album = albums_model.get_album_details(album_id)
         tags = bandcamp.scrape_bandcamp_tags_from_url(album.album_url)
         if tags:
-            deferred_process_tags.delay(album_id, tags)
-    except DatabaseError as e:
-        print(f'[db]: failed to get album details for {album_id}')
-        print(f'[db]: {e}')
+            # written here (buffered, as covers and release dates are) rather than queued
+            deferred_process_tags(album_id, tags, buffered=True)
     except (TypeError, ValueError):
         pass
     else:
         print(f'[scraper]: processed tags for {album_id}')
 
 
-@delayed.queue_func
-def deferred_process_album_released(album_id):
+def process_album_released(album_id, album):
     try:
-        album = albums_model.get_album_details(album_id)
         date = bandcamp.scrape_bandcamp_album_released_from_url(album.album_url)
         if date:
-            albums_model.add_released_to_album(album_id, date)
+            albums_model.add_released_to_album(album_id, date, buffered=True)
             print(f'[scraper]: added release date {date} to {album_id}')
     except DatabaseError as e:
-        print(f'[db]: failed to get album details for {album_id}')
+        print(f'[db]: failed to add release date to {album_id}')
         print(f'[db]: {e}')
     except (TypeError, ValueError):
         pass
@@ -413,13 +417,144 @@ def deferred_process_album_released(album_id):
         print(f'[scraper]: processed release date for {album_id}')
 
 
+def check_album_url(album_id, album, check_for_new_url=True):
+    try:
+        response = requests.head(album.album_url)
+        if response.ok and not album.available:
+            print(f'[scraper]: [{album_id}] {album.album_name} by {album.album_artist} is now available')
+            albums_model.update_album_availability(album_id, True, buffered=True)
+
+        elif response.status_code > 400:
+
+            if check_for_new_url:
+                try:
+                    _, _, album_url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
+                    if album_url != album.album_url:
+                        print(f'[scraper] alternative album URL found at {album_url} for {album_id}')
+                        albums_model.update_album_url(album_id, album_url, buffered=True)
+                        return
+                except TypeError:
+                    print(f'[scraper] no alternative URL found for {album_id}')
+                except DatabaseError as e:
+                    print(f'[db]: failed to update album URL for {album_id}')
+                    print(f'[db]: {e}')
+
+            if album.available:
+                albums_model.update_album_availability(album_id, False, buffered=True)
+                message = f'[{album_id}] {album.album_name} by {album.album_artist} is no longer available'
+                print(f'[scraper]: {message}')
+
+    except DatabaseError as e:
+        print('[db]: failed to update album after check')
+        print(f'[db]: {e}')
+    except (TypeError, ValueError):
+        pass
+    else:
+        print(f'[scraper]: checked availability for {album_id}')
+
+
+def attribute_album_url(album_id, album, slack):
+    try:
+        album_url = album.album_url
+        response = slack.search.all(album_url)
+        if response.successful:
+            for match in response.body['messages']['matches']:
+                user = match['user']
+                if user:
+                    albums_model.add_user_to_album(album_id, user)
+                    print(f'[scraper]: added {user} to {album_id}')
+                elif 'previous' in match and album_url in match['previous']['text']:
+                    albums_model.add_user_to_album(album_id, match['previous']['user'])
+                    print(f'[scraper]: added {match["previous"]["user"]} to {album_id}')
+                elif 'previous2' in match and album_url in match['previous2']['text']:
+                    albums_model.add_user_to_album(album_id, match['previous2']['user'])
+                    print(f'[scraper]: added {match["previous2"]["user"]} to {album_id}')
+    except (DatabaseError, KeyError) as e:
+        print('[db]: failed to attribute users to album')
+        print(f'[db]: {e}')
+
+
+def get_album_batch(album_ids):
+    """
+    Load a batch task's albums in one query, logging (rather than raising)
+    a failure, as the single-album tasks do.
+    """
+    try:
+        return list(albums_model.get_album_details_from_ids(tuple(album_ids))) if album_ids else []
+    except DatabaseError as e:
+        print(f'[db]: failed to get album details for a batch of {len(album_ids)} albums')
+        print(f'[db]: {e}')
+        return []
+
+
+def process_batch(album_ids, process, *args):
+    """
+    Call process(album_id, album, *args) for each album of a batch task, so
+    that one failed request doesn't lose the rest of the batch.
+    """
+    for album in get_album_batch(album_ids):
+        try:
+            process(album.album_id, album, *args)
+        except Exception as e:
+            print(f'[scraper]: failed to process {album.album_id}: {e}')
+
+
 @delayed.queue_func
+def deferred_process_album_cover(album_id):
+    try:
+        album = albums_model.get_album_details(album_id)
+    except DatabaseError as e:
+        print(f'[db]: failed to add album cover for {album_id}')
+        print(f'[db]: {e}')
+    else:
+        process_album_cover(album_id, album)
+
+
+@delayed.queue_func(lane='maintenance')
+def deferred_process_album_cover_batch(album_ids):
+    process_batch(album_ids, process_album_cover)
+
+
+@delayed.queue_func
+def deferred_process_album_tags(album_id):
+    try:
+        album = albums_model.get_album_details(album_id)
+    except DatabaseError as e:
+        print(f'[db]: failed to get album details for {album_id}')
+        print(f'[db]: {e}')
+    else:
+        process_album_tags(album_id, album)
+
+
+@delayed.queue_func(lane='maintenance')
+def deferred_process_album_tags_batch(album_ids):
+    process_batch(album_ids, process_album_tags)
+
+
+@delayed.queue_func
+def deferred_process_album_released(album_id):
+    try:
+        album = albums_model.get_album_details(album_id)
+    except DatabaseError as e:
+        print(f'[db]: failed to get album details for {album_id}')
+        print(f'[db]: {e}')
+    else:
+        process_album_released(album_id, album)
+
+
+@delayed.queue_func(lane='maintenance')
+def deferred_process_album_released_batch(album_ids):
+    process_batch(album_ids, process_album_released)
+
+
+@delayed.queue_func(lane='maintenance')
 def deferred_process_all_album_covers(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums_without_covers():
-            deferred_process_album_cover.delay(album.album_id)
+        album_ids = (album.album_id for album in albums_model.get_albums_without_covers())
+        batches = delayed.batches(album_ids, BATCH_SIZE)
+        deferred_process_album_cover_batch.delay_many((batch, ) for batch in batches)
     except DatabaseError as e:
         print('[db]: failed to get all album details')
         print(f'[db]: {e}')
@@ -430,13 +565,14 @@ def deferred_process_all_album_covers(response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
 def deferred_process_all_album_tags(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums():
-            deferred_process_album_tags.delay(album.album_id)
+        album_ids = albums_model.get_album_ids(stream=True)
+        batches = delayed.batches(album_ids, BATCH_SIZE)
+        deferred_process_album_tags_batch.delay_many((batch, ) for batch in batches)
     except DatabaseError as e:
         print('[db]: failed to get all album details')
         print(f'[db]: {e}')
@@ -447,13 +583,14 @@ def deferred_process_all_album_tags(response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
 def deferred_process_all_album_released(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Process started...'}))
-        for album in albums_model.get_albums():
-            deferred_process_album_released.delay(album.album_id)
+        album_ids = albums_model.get_album_ids(stream=True)
+        batches = delayed.batches(album_ids, BATCH_SIZE)
+        deferred_process_album_released_batch.delay_many((batch, ) for batch in batches)
     except DatabaseError as e:
         print('[db]: failed to get all album details')
         print(f'[db]: {e}')
@@ -464,51 +601,30 @@ def deferred_process_all_album_released(response_url=None):
         requests.post(response_url, data=json.dumps({'text': message}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
 def deferred_check_album_url(album_id, check_for_new_url=True):
     try:
         album = albums_model.get_album_details(album_id)
-        response = requests.head(album.album_url)
-        if response.ok and not album.available:
-            print(f'[scraper]: [{album_id}] {album.album_name} by {album.album_artist} is now available')
-            albums_model.update_album_availability(album_id, True)
-
-        elif response.status_code > 400:
-
-            if check_for_new_url:
-                try:
-                    _, _, album_url = bandcamp.scrape_bandcamp_album_details_from_id(album_id)
-                    if album_url != album.album_url:
-                        print(f'[scraper] alternative album URL found at {album_url} for {album_id}')
-                        albums_model.update_album_url(album_id, album_url)
-                        return
-                except TypeError:
-                    print(f'[scraper] no alternative URL found for {album_id}')
-                except DatabaseError as e:
-                    print(f'[db]: failed to update album URL for {album_id}')
-                    print(f'[db]: {e}')
-
-            if album.available:
-                albums_model.update_album_availability(album_id, False)
-                message = f'[{album_id}] {album.album_name} by {album.album_artist} is no longer available'
-                print(f'[scraper]: {message}')
-
     except DatabaseError as e:
         print('[db]: failed to update album after check')
         print(f'[db]: {e}')
-    except (TypeError, ValueError):
-        pass
     else:
-        print(f'[scraper]: checked availability for {album_id}')
+        check_album_url(album_id, album, check_for_new_url)
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
+def deferred_check_album_url_batch(album_ids, check_for_new_url=True):
+    process_batch(album_ids, check_album_url, check_for_new_url)
+
+
+@delayed.queue_func(lane='maintenance')
 def deferred_check_all_album_urls(response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Check started...'}))
-        for album_id in albums_model.get_album_ids():
-            deferred_check_album_url.delay(album_id)
+        album_ids = albums_model.get_album_ids(stream=True)
+        batches = delayed.batches(album_ids, BATCH_SIZE)
+        deferred_check_album_url_batch.delay_many((batch, ) for batch in batches)
     except DatabaseError as e:
         print('[db]: failed to check for new album details')
         print(f'[db]: {e}')
@@ -516,37 +632,31 @@ def deferred_check_all_album_urls(response_url=None):
             requests.post(response_url, data=json.dumps({'text': 'failed to check all album urls'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
 def deferred_attribute_album_url(album_id, slack_token):
     try:
         album = albums_model.get_album_details(album_id)
-        album_url = album.album_url
-        slack = slacker.Slacker(slack_token)
-        response = slack.search.all(album_url)
-        if response.successful:
-            for match in response.body['messages']['matches']:
-                user = match['user']
-                if user:
-                    albums_model.add_user_to_album(album_id, user)
-                    print(f'[scraper]: added {user} to {album_id}')
-                elif 'previous' in match and album_url in match['previous']['text']:
-                    albums_model.add_user_to_album(album_id, match['previous']['user'])
-                    print(f'[scraper]: added {match["previous"]["user"]} to {album_id}')
-                elif 'previous2' in match and album_url in match['previous2']['text']:
-                    albums_model.add_user_to_album(album_id, match['previous2']['user'])
-                    print(f'[scraper]: added {match["previous2"]["user"]} to {album_id}')
-    except (DatabaseError, KeyError) as e:
+    except DatabaseError as e:
         print('[db]: failed to attribute users to album')
         print(f'[db]: {e}')
+    else:
+        attribute_album_url(album_id, album, slacker.Slacker(slack_token))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
+def deferred_attribute_album_url_batch(album_ids, slack_token):
+    slack = slacker.Slacker(slack_token)
+    process_batch(album_ids, attribute_album_url, slack)
+
+
+@delayed.queue_func(lane='maintenance')
 def deferred_attribute_users_to_all_album_urls(slack_token, response_url=None):
     try:
         if response_url:
             requests.post(response_url, data=json.dumps({'text': 'Attribution started...'}))
-        for album_id in albums_model.get_album_ids():
-            deferred_attribute_album_url.delay(album_id, slack_token)
+        album_ids = albums_model.get_album_ids(stream=True)
+        batches = delayed.batches(album_ids, BATCH_SIZE)
+        deferred_attribute_album_url_batch.delay_many((batch, slack_token) for batch in batches)
     except DatabaseError as e:
         print('[db]: failed to start attribution process')
         print(f'[db]: {e}')
@@ -554,7 +664,7 @@ def deferred_attribute_users_to_all_album_urls(slack_token, response_url=None):
             requests.post(response_url, data=json.dumps({'text': 'Failed to check all album urls'}))
 
 
-@delayed.queue_func
+@delayed.queue_func(lane='maintenance')
 def deferred_ping_albumlistbot():
     slack_token = flask.current_app.config['SLACK_OAUTH_TOKEN']
     albumlistbot_url = flask.current_app.config['ALBUMLISTBOT_URL']
@@ -573,6 +683,6 @@ def deferred_fetch_and_restore(url_to_csv):
         f = io.StringIO(response.text)
         reader = csv.DictReader(f)
         for album_details in reader:
-            deferred_add_new_album_details.delay(albums_model.Album.from_dict(album_details))
+            deferred_add_new_album_details.delay(dict(album_details))
     else:
         print('[restore]: failed to get csv')
@@ -0,0 +1,137 @@
+import asyncio
+import functools
+
+from albumlist import delayed
+from albumlist.delayed import queued
+from albumlist.models import DatabaseError
+from albumlist.models import albums as albums_model
+from albumlist.scrapers import NotFoundError
+from albumlist.scrapers import bandcamp_async
+
+
+# asyncio versions of the I/O-bound tasks in queued, for WORKER_MODE=async: they scrape
+# through the worker's shared Fetcher, and run model calls (which block) in the executor
+def blocking(func, *args, **kwargs):
+    return asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def process_album_cover(fetcher, album_id, album):
+    try:
+        album_cover_url = await bandcamp_async.scrape_bandcamp_album_cover_url_from_url(fetcher, album.album_url)
+        await blocking(albums_model.add_img_to_album, album_id, album_cover_url, buffered=True)
+    except DatabaseError as e:
+        print(f'[db]: failed to add album cover for {album_id}')
+        print(f'[db]: {e}')
+    except NotFoundError as e:
+        print(f'[scraper]: failed to find album art for {album_id}')
+        print(f'[scraper]: {e}')
+    except (TypeError, ValueError):
+        pass
+    else:
+        print(f'[scraper]: processed cover for {album_id}')
+
+
+async def process_album_tags(fetcher, album_id, album):
+    try:
+        tags = await bandcamp_async.scrape_bandcamp_tags_from_url(fetcher, album.album_url)
+        if tags:
+            await blocking(queued.deferred_process_tags, album_id, tags, buffered=True)
+    except (TypeError, ValueError):
+        pass
+    else:
+        print(f'[scraper]: processed tags for {album_id}')
+
+
+async def process_album_released(fetcher, album_id, album):
+    try:
+        date = await bandcamp_async.scrape_bandcamp_album_released_from_url(fetcher, album.album_url)
+        if date:
+            await blocking(albums_model.add_released_to_album, album_id, date, buffered=True)
+            print(f'[scraper]: added release date {date} to {album_id}')
+    except DatabaseError as e:
+        print(f'[db]: failed to add release date to {album_id}')
+        print(f'[db]: {e}')
+    except (TypeError, ValueError):
+        pass
+    else:
+        print(f'[scraper]: processed release date for {album_id}')
+
+
+async def check_album_url(fetcher, album_id, album, check_for_new_url=True):
+    try:
+        status = await fetcher.head(album.album_url)
+        if status < 400 and not album.available:
+            print(f'[scraper]: [{album_id}] {album.album_name} by {album.album_artist} is now available')
+            await blocking(albums_model.update_album_availability, album_id, True, buffered=True)
+
+        elif status > 400:
+
+            if check_for_new_url:
+                try:
+                    _, _, album_url = await bandcamp_async.scrape_bandcamp_album_details_from_id(fetcher, album_id)
+                    if album_url != album.album_url:
+                        print(f'[scraper] alternative album URL found at {album_url} for {album_id}')
+                        await blocking(albums_model.update_album_url, album_id, album_url, buffered=True)
+                        return
+                except TypeError:
+                    print(f'[scraper] no alternative URL found for {album_id}')
+                except DatabaseError as e:
+                    print(f'[db]: failed to update album URL for {album_id}')
+                    print(f'[db]: {e}')
+
+            if album.available:
+                await blocking(albums_model.update_album_availability, album_id, False, buffered=True)
+                message = f'[{album_id}] {album.album_name} by {album.album_artist} is no longer available'
+                print(f'[scraper]: {message}')
+
+    except DatabaseError as e:
+        print('[db]: failed to update album after check')
+        print(f'[db]: {e}')
+    except (TypeError, ValueError):
+        pass
+    else:
+        print(f'[scraper]: checked availability for {album_id}')
+
+
+def single(task, process, error):
+    """
+    Register an async variant of a single-album task that looks the album up
+    and then awaits process(fetcher, album_id, album, *args).
+    """
+    @delayed.async_variant(task)
+    async def run(fetcher, album_id, *args):
+        try:
+            album = await blocking(albums_model.get_album_details, album_id)
+        except DatabaseError as e:
+            print(error.format(album_id=album_id))
+            print(f'[db]: {e}')
+        else:
+            await process(fetcher, album_id, album, *args)
+    return run
+
+
+def batch(task, process):
+    """
+    Register an async variant of a batch task that loads its albums in one
+    query and then processes them all concurrently.
+    """
+    @delayed.async_variant(task)
+    async def run(fetcher, album_ids, *args):
+        albums = await blocking(queued.get_album_batch, album_ids)
+        results = await asyncio.gather(*(process(fetcher, album.album_id, album, *args) for album in albums),
+                                       return_exceptions=True)
+        for album, result in zip(albums, results):
+            if isinstance(result, Exception):
+                print(f'[scraper]: failed to process {album.album_id}: {result}')
+    return run
+
+
+single(queued.deferred_process_album_cover, process_album_cover, '[db]: failed to add album cover for {album_id}')
+single(queued.deferred_process_album_tags, process_album_tags, '[db]: failed to get album details for {album_id}')
+single(queued.deferred_process_album_released, process_album_released,
+       '[db]: failed to get album details for {album_id}')
+single(queued.deferred_check_album_url, check_album_url, '[db]: failed to update album after check')
+batch(queued.deferred_process_album_cover_batch, process_album_cover)
+batch(queued.deferred_process_album_tags_batch, process_album_tags)
+batch(queued.deferred_process_album_released_batch, process_album_released)
+batch(queued.deferred_check_album_url_batch, check_album_url)
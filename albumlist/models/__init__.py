@@ -1,19 +1,45 @@
+import collections
+import io
 import os
-from contextlib import closing
+import threading
+import time
+from contextlib import closing, contextmanager
 
 import psycopg2
+import psycopg2.extensions
 from urllib.parse import urlparse
 
 
 # urlparse.uses_netloc.append("postgres")
 
-class DatabaseError(Exception): 
+class DatabaseError(Exception):
     pass
 
 
-def get_connection():
-    db_url = urlparse(os.environ['DATABASE_URL'])
-    try:
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of connections to a single database.
+
+    Connections are checked for health on checkout: closed or broken
+    connections (e.g. after a failover) are discarded and replaced, and
+    connections that have sat idle for longer than `recycle` seconds are
+    pinged before being handed out.
+    """
+
+    def __init__(self, db_url, maxconn=5, timeout=5.0, recycle=30.0):
+        self.db_url = db_url
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pid = os.getpid()
+        self.stats = collections.Counter()
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def _connect(self):
+        db_url = urlparse(self.db_url)
+        self.stats['connects'] += 1
         return psycopg2.connect(
             database=db_url.path[1:],
             user=db_url.username,
@@ -21,8 +47,193 @@ def get_connection():
             host=db_url.hostname,
             port=db_url.port
         )
-    except psycopg2.OperationalError as e:
-        raise DatabaseError(e)
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.recycle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self.stats['discards'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            with self._condition:
+                if not waited:
+                    self.stats['checkouts'] += 1
+                while not self._idle and self._size >= self.maxconn:
+                    if not waited:
+                        self.stats['waits'] += 1
+                        waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise DatabaseError('timed out waiting for a database connection')
+                    self._condition.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn = None
+                    self._size += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except psycopg2.OperationalError as e:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise DatabaseError(e)
+            if self._is_healthy(conn, idle_since):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+    def get_stats(self):
+        with self._condition:
+            return dict(self.stats, size=self._size, idle=len(self._idle), maxconn=self.maxconn)
+
+
+class PooledConnection:
+    """
+    Proxy for a pooled connection that returns it to the pool on close,
+    so that `closing(get_connection())` keeps working unchanged.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.putconn(conn)
+
+    def discard(self):
+        if self._conn is not None:
+            self._conn.close()
+            self.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_routing = threading.local()
+
+
+def get_pool(url_key='DATABASE_URL'):
+    pool = _pools.get(url_key)
+    # pools are per-process: a forked gunicorn worker must not share sockets with its parent
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(url_key)
+            if pool is None or pool.pid != os.getpid():
+                pool = _pools[url_key] = ConnectionPool(
+                    os.environ[url_key],
+                    maxconn=int(os.environ.get('DATABASE_POOL_SIZE', 5)),
+                    timeout=float(os.environ.get('DATABASE_POOL_TIMEOUT', 5)),
+                    recycle=float(os.environ.get('DATABASE_POOL_RECYCLE', 30)),
+                )
+    return pool
+
+
+def get_pool_stats():
+    stats = {'primary': get_pool().get_stats()}
+    if 'DATABASE_REPLICA_URL' in os.environ:
+        stats['replica'] = get_pool('DATABASE_REPLICA_URL').get_stats()
+    return stats
+
+
+@contextmanager
+def use_primary():
+    """
+    Route read-only model calls made inside this block to the primary, for
+    flows that must see their own (or another worker's) recent writes.
+    """
+    depth = getattr(_routing, 'primary', 0)
+    _routing.primary = depth + 1
+    try:
+        yield
+    finally:
+        _routing.primary = depth
+
+
+def primary_required():
+    return bool(getattr(_routing, 'primary', 0))
+
+
+def uses_replica(read_only=True):
+    return read_only and 'DATABASE_REPLICA_URL' in os.environ and not primary_required()
+
+
+def get_connection(read_only=False):
+    """
+    Check out a pooled connection to the primary, or to the replica at
+    DATABASE_REPLICA_URL (if configured) for read-only callers, falling back
+    to the primary if the replica is unreachable.
+    """
+    if uses_replica(read_only):
+        pool = get_pool('DATABASE_REPLICA_URL')
+        try:
+            return PooledConnection(pool, pool.getconn())
+        except DatabaseError as e:
+            print(f'[db]: replica unavailable, using primary: {e}')
+    pool = get_pool()
+    return PooledConnection(pool, pool.getconn())
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    Load rows into a table with a single COPY FROM STDIN (text format).
+    """
+    data = io.StringIO(''.join(
+        '\t'.join(_copy_value(value) for value in row) + '\n'
+        for row in rows
+    ))
+    cur.copy_from(data, table, columns=columns)
 
 
 def add_column(table, col, col_type):
@@ -1,16 +1,45 @@
+import ast
+import atexit
 import json
+import os
+import queue
+import random
+import re
+import threading
+import time
 from contextlib import closing
 from datetime import datetime
 
 import psycopg2
-from psycopg2.extras import NamedTupleCursor
+from psycopg2.extras import execute_values
 
-from albumlist.models import DatabaseError, get_connection
-from albumlist.models.list import get_list
+from albumlist import versions
+from albumlist.models import DatabaseError, catalog, copy_rows, counts, get_connection, primary_required, uses_replica
+
+
+ITERSIZE = int(os.environ.get('DATABASE_ITERSIZE', 2000))
+
+# album writes return these for versions.bump_albums
+VERSIONED = 'RETURNING id, channel, tags_json, users_json'
+# the same for UPDATEs that join the row's previous values in as "old", so
+# that tags and users being taken away bump their versions too
+VERSIONED_WITH_OLD = """
+    RETURNING albums.id, albums.channel,
+    COALESCE(albums.tags_json, '[]') || COALESCE(old.tags_json, '[]'),
+    COALESCE(albums.users_json, '[]') || COALESCE(old.users_json, '[]')
+    """
 
 
 class Album:
 
+    # column names in constructor order, which the model queries select a prefix of
+    COLUMNS = ('id', 'name', 'artist', 'url', 'img', 'available', 'channel', 'added', 'released',
+               'tags_json', 'users_json', 'reviews_json')
+    FIELDNAMES = ('added', 'album', 'artist', 'channel', 'id', 'img', 'released', 'reviews', 'tags', 'url', 'users')
+
+    __slots__ = ('album_id', 'album_artist', 'album_name', 'album_url', 'album_image', 'channel',
+                 'available', 'added', 'released', 'reviews', 'tags', 'users')
+
     def __init__(self, id, name, artist, url, img, available, channel, added, released, tags_json=None, users_json=None, reviews_json=None):
         self.album_id = id
         self.album_artist = artist
@@ -27,7 +56,7 @@ class Album:
 
     @property
     def fieldnames(self):
-        return list(self.to_dict().keys())
+        return list(self.FIELDNAMES)
 
     @classmethod
     def from_dict(cls, d):
@@ -39,11 +68,11 @@ class Album:
             img=d['img'],
             available=True,
             channel=d['channel'],
-            added=datetime.strptime(d['added'], '%Y-%m-%dT%H:%M:%S.%f'),
+            added=parse_dumped_added(d['added']),
             released=d['released'],
-            tags_json=d['tags'],
-            users_json=d['users'],
-            reviews_json=d['reviews'],
+            tags_json=parse_dumped_list(d['tags']),
+            users_json=parse_dumped_list(d['users']),
+            reviews_json=parse_dumped_list(d['reviews']),
         )
 
     def to_dict(self):
@@ -63,10 +92,11 @@ class Album:
 
     @classmethod
     def from_values(cls, values):
-        try:
+        if not values:
+            return None
+        if hasattr(values, '_fields'):
             return cls(**values._asdict())
-        except AttributeError:
-            return cls(*values) if values else None
+        return cls(*values)
 
     @classmethod
     def albums_from_values(cls, list_of_values):
@@ -75,6 +105,30 @@ class Album:
         for values in list_of_values:
             yield cls.from_values(values)
 
+    @classmethod
+    def row_factory(cls, description):
+        """
+        Return a function that builds an Album from a plain row tuple with
+        the given cursor description, decided once per query: rows whose
+        columns are a prefix of COLUMNS go straight to the constructor,
+        anything else is matched up by column name.
+        """
+        names = tuple(column[0] for column in description)
+        if names == cls.COLUMNS[:len(names)]:
+            return lambda values: cls(*values)
+        return lambda values: cls(**dict(zip(names, values)))
+
+    @classmethod
+    def from_cursor(cls, cur):
+        values = cur.fetchone()
+        return cls.row_factory(cur.description)(values) if values else None
+
+    @classmethod
+    def albums_from_cursor(cls, cur):
+        # fetch now, while the connection is still checked out
+        make_album = cls.row_factory(cur.description)
+        return (make_album(values) for values in cur.fetchall())
+
     @staticmethod
     def details_map_from_albums(albums):
         details = dict()
@@ -89,11 +143,154 @@ class Album:
             artist=self.album_artist,
             name=self.album_name,
             url=self.album_url,
-            im=self.album_image,
+            img=self.album_image,
             channel=self.channel,
         )
 
 
+def parse_dumped_added(value):
+    """
+    Parse 'added' from an albums CSV: dumps made with Album.to_dict leave
+    out the microseconds when they are zero, COPY dumps always have them.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_dumped_list(value):
+    """
+    Parse tags, users or reviews from an albums CSV: COPY dumps have them
+    as JSON, dumps made with Album.to_dict as Python reprs.
+    """
+    if not value:
+        return []
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+class AlbumUpdateBuffer:
+    """
+    Coalesces single-column album updates pushed by workers, writing each
+    column's pending values as one UPDATE ... FROM (VALUES ...) once
+    `max_size` updates are waiting or `interval` seconds have passed.
+    """
+
+    COLUMN_TYPES = {
+        'img': 'varchar',
+        'url': 'varchar',
+        'released': 'varchar',
+        'available': 'boolean',
+        'tags_json': 'jsonb',
+    }
+
+    def __init__(self, max_size=500, interval=2.0):
+        self.max_size = max_size
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(updates) for updates in self._pending.values())
+
+    def push(self, album_id, column, value):
+        if column not in self.COLUMN_TYPES:
+            raise ValueError(f'cannot buffer updates to {column}')
+        with self._lock:
+            # a later update to the same album and column replaces an earlier one
+            self._pending.setdefault(column, {})[album_id] = value
+            size = sum(len(updates) for updates in self._pending.values())
+            due = size >= self.max_size or time.monotonic() - self._last_flush >= self.interval
+            if not due:
+                self._schedule()
+        if due:
+            self.flush()
+
+    def _schedule(self):
+        # called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except DatabaseError as e:
+            print('[db]: failed to flush buffered album updates')
+            print(f'[db]: {e}')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        changed = []
+        try:
+            with closing(get_connection()) as conn:
+                cur = conn.cursor()
+                for column, updates in pending.items():
+                    sql = f"""
+                        UPDATE albums
+                        SET {column} = v.value::{self.COLUMN_TYPES[column]}
+                        FROM (VALUES %s) AS v (id, value), albums AS old
+                        WHERE albums.id = v.id AND old.id = v.id
+                        {VERSIONED_WITH_OLD};
+                        """
+                    # one page, so that every returned row can be fetched
+                    execute_values(cur, sql, list(updates.items()), page_size=len(updates))
+                    changed.extend(cur.fetchall())
+                conn.commit()
+        except (psycopg2.Error, DatabaseError) as e:
+            # including OperationalErrors, such as a dropped connection: nothing was committed
+            self._requeue(pending)
+            raise e if isinstance(e, DatabaseError) else DatabaseError(e)
+        versions.bump_albums(changed)
+        return sum(len(updates) for updates in pending.values())
+
+    def _requeue(self, pending):
+        """
+        Put a batch that failed to write back in the buffer, and make sure
+        that a timer will retry it even if nothing more is pushed.
+        """
+        with self._lock:
+            for column, updates in pending.items():
+                for album_id, value in updates.items():
+                    # keep anything pushed since, as it is newer
+                    self._pending.setdefault(column, {}).setdefault(album_id, value)
+            self._schedule()
+        print(f'[db]: requeued {sum(len(updates) for updates in pending.values())} buffered album updates')
+
+
+update_buffer = AlbumUpdateBuffer(
+    max_size=int(os.environ.get('ALBUM_UPDATE_BATCH_SIZE', 500)),
+    interval=float(os.environ.get('ALBUM_UPDATE_INTERVAL', 2)),
+)
+
+
+def flush_album_updates():
+    try:
+        return update_buffer.flush()
+    except DatabaseError as e:
+        print('[db]: failed to flush buffered album updates')
+        print(f'[db]: {e}')
+
+
+atexit.register(flush_album_updates)
+
+
 def create_albums_table():
     sql = """
         CREATE TABLE IF NOT EXISTS albums (
@@ -134,44 +331,291 @@ def create_albums_index():
             raise DatabaseError(e)
 
 
-def get_albums():
+def create_albums_random_key():
+    """
+    Add random_key without rewriting the table (as a volatile default on
+    ADD COLUMN would), backfill it, and then check it is never NULL, with a
+    constraint validated without blocking writes. The migration builds its
+    indexes concurrently afterwards.
+    """
+    sql = """
+        DO $$
+        BEGIN
+            ALTER TABLE albums ADD COLUMN random_key double precision;
+        EXCEPTION WHEN duplicate_column THEN NULL;
+        END $$;
+        ALTER TABLE albums ALTER COLUMN random_key SET DEFAULT random();
+        CREATE TABLE IF NOT EXISTS random_cycles (
+        name varchar PRIMARY KEY,
+        position double precision NOT NULL DEFAULT -1
+        );"""
+    constraint_sql = """
+        DO $$
+        BEGIN
+            ALTER TABLE albums ADD CONSTRAINT albums_random_key_not_null
+            CHECK (random_key IS NOT NULL) NOT VALID;
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$;"""
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+            backfill_albums('random_key = random()', 'random_key IS NULL')
+            cur.execute(constraint_sql)
+            conn.commit()
+            cur.execute('ALTER TABLE albums VALIDATE CONSTRAINT albums_random_key_not_null;')
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def create_albums_search():
+    sql = """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        DO $$
+        BEGIN
+            ALTER TABLE albums ADD COLUMN search_vector tsvector;
+        EXCEPTION WHEN duplicate_column THEN NULL;
+        END $$;
+
+        CREATE OR REPLACE FUNCTION albums_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('simple', COALESCE(NEW.name, '')), 'A') ||
+                setweight(to_tsvector('simple', COALESCE(NEW.artist, '')), 'A') ||
+                setweight(to_tsvector('simple', array_to_string(
+                    ARRAY(SELECT jsonb_array_elements_text(COALESCE(NEW.tags_json, '[]'))), ' '
+                )), 'B');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS albums_search_vector ON albums;
+        CREATE TRIGGER albums_search_vector
+        BEFORE INSERT OR UPDATE OF name, artist, tags_json ON albums
+        FOR EACH ROW EXECUTE PROCEDURE albums_search_vector();"""
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+    backfill_albums_search()
+
+
+def backfill_albums_search(batch_size=5000):
+    """
+    Fill in search_vector for existing albums, by touching their names for
+    the trigger.
+    """
+    backfill_albums('name = name', 'search_vector IS NULL', batch_size)
+
+
+def backfill_albums(assignment, condition, batch_size=5000):
+    """
+    Apply `assignment` to the albums matching `condition`, one id range at a
+    time, committing each, so that no long transaction holds row locks on
+    the whole table.
+    """
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            last_id = ''
+            while True:
+                cur.execute('SELECT MAX(id) FROM (SELECT id FROM albums WHERE id > %s ORDER BY id LIMIT %s) AS batch;',
+                            (last_id, batch_size))
+                upper_id = cur.fetchone()[0]
+                if upper_id is None:
+                    break
+                cur.execute(f"""
+                    UPDATE albums SET {assignment}
+                    WHERE id > %s AND id <= %s AND {condition};
+                    """, (last_id, upper_id))
+                conn.commit()
+                last_id = upper_id
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def stream_rows(sql, params=None, itersize=None, row_factory=None, read_only=True):
+    """
+    Yield rows from a named (server-side) cursor, fetching `itersize`
+    rows per round trip so that the full result never sits in memory.
+    """
+    with closing(get_connection(read_only=read_only)) as conn:
+        try:
+            cur = conn.cursor(name='albumlist_stream')
+            cur.itersize = itersize or ITERSIZE
+            cur.execute(sql, params)
+            for values in cur:
+                yield row_factory(values) if row_factory else values
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def stream_albums(sql, params=None, itersize=None):
+    return stream_rows(sql, params, itersize=itersize, row_factory=Album.from_values)
+
+
+class _ChunkWriter:
+    """
+    File-like sink for COPY TO that batches rows into chunks and hands them
+    to a (bounded) queue, giving up if the reader goes away.
+    """
+
+    def __init__(self, chunks, cancelled, chunk_size):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise IOError('reader cancelled')
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._put(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+
+ALBUMS_CSV_SQL = """
+    COPY (
+        SELECT
+            to_char(added, 'YYYY-MM-DD"T"HH24:MI:SS.US') AS added,
+            COALESCE(name, '') AS album,
+            COALESCE(artist, '') AS artist,
+            COALESCE(channel, '') AS channel,
+            id,
+            COALESCE(img, '') AS img,
+            COALESCE(released, '') AS released,
+            COALESCE(reviews_json, '[]') AS reviews,
+            COALESCE(tags_json, '[]') AS tags,
+            COALESCE(url, '') AS url,
+            COALESCE(users_json, '[]') AS users
+        FROM albums
+    ) TO STDOUT WITH CSV HEADER
+"""
+
+
+def stream_albums_csv(chunk_size=64 * 1024):
+    """
+    Yield the albums table as CSV (with the same columns as Album.to_dict)
+    in chunks of bytes, as Postgres produces them via COPY TO STDOUT.
+    Unlike the to_dict rows of older dumps, tags, users and reviews are
+    JSON and 'added' always has microseconds; Album.from_dict reads both.
+    """
+    # routing is per thread, so pass the caller's on to the copying thread
+    read_only = not primary_required()
+    chunks = queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+    done = object()
+
+    def copy():
+        writer = _ChunkWriter(chunks, cancelled, chunk_size)
+        result = done
+        try:
+            with closing(get_connection(read_only=read_only)) as conn:
+                try:
+                    conn.cursor().copy_expert(ALBUMS_CSV_SQL, writer)
+                except Exception:
+                    # abandoned or failed mid-COPY: the connection is not reusable
+                    conn.discard()
+                    raise
+            writer.flush()
+        except psycopg2.Error as e:
+            result = DatabaseError(e)
+        except Exception as e:
+            result = e
+        finally:
+            # whatever happened, the reader (if it is still there) must not wait forever
+            if not cancelled.is_set():
+                try:
+                    writer._put(result)
+                except IOError:
+                    pass
+
+    threading.Thread(target=copy, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+
+
+def get_albums(stream=False, itersize=None):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot and not stream:
+        return Album.albums_from_values(snapshot.select(9))
+    if stream:
+        return stream_albums(sql, itersize=itersize)
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_with_tags():
+def get_albums_with_tags(stream=False, itersize=None):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot and not stream:
+        return Album.albums_from_values(snapshot.select(10))
+    if stream:
+        return stream_albums(sql, itersize=itersize)
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_with_users():
+def get_albums_with_users(stream=False, itersize=None):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json, users_json
         FROM albums
     """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot and not stream:
+        return Album.albums_from_values(snapshot.select(11))
+    if stream:
+        return stream_albums(sql, itersize=itersize)
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -182,70 +626,79 @@ def get_albums_by_channel_with_tags(channel):
         FROM albums
         WHERE channel = %s;
     """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        return Album.albums_from_values(snapshot.select(10, channel=channel))
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (channel,))
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_available():
+def get_albums_available(stream=False, itersize=None):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released
         FROM albums
         WHERE available = true;
     """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot and not stream:
+        return Album.albums_from_values(snapshot.select(9, available=True))
+    if stream:
+        return stream_albums(sql, itersize=itersize)
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_unavailable():
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released
-        FROM albums 
-        WHERE available = false;
+ALBUMS_UNAVAILABLE_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released
+    FROM albums
+    WHERE available = false;
     """
-    with closing(get_connection()) as conn:
+
+
+def get_albums_unavailable():
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        return Album.albums_from_values(snapshot.select(9, available=False))
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
-            cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            cur.execute(ALBUMS_UNAVAILABLE_SQL)
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_without_covers():
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released
-        FROM albums
-        WHERE img = '';
+ALBUMS_WITHOUT_COVERS_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released
+    FROM albums
+    WHERE img = '';
     """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
 
 
-def get_albums_count():
-    with closing(get_connection()) as conn:
+def get_albums_without_covers():
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT id FROM albums;')
-            return cur.rowcount
+            cur.execute(ALBUMS_WITHOUT_COVERS_SQL)
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
+def get_albums_count(estimated=False):
+    return counts.get_count('albums', estimated=estimated)
+
+
 def find_album_artist_duplicates():
     sql = """
         SELECT a1.* from (SELECT id, LOWER(name) as name, LOWER(artist) as artist, url, img, available, channel, added, released from albums) a1
@@ -254,53 +707,61 @@ def find_album_artist_duplicates():
         WHERE a2.duplicates > 1
         ORDER BY a1.artist, a1.name
     """
-    with closing(get_connection()) as conn:
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql)
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def get_albums_unavailable_count():
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT id FROM albums WHERE available = false;')
-            return cur.rowcount
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return counts.get_count('albums_unavailable')
+
+
+def _get_album(sql, params):
+    """
+    Fetch a single album from the replica, retrying on the primary if the
+    replica doesn't have it (yet), e.g. when it was only just added.
+    """
+    for read_only in ((True, False) if uses_replica() else (False, )):
+        with closing(get_connection(read_only=read_only)) as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute(sql, params)
+                album = Album.from_cursor(cur)
+            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+        if album is not None:
+            return album
+    return None
+
+
+ALBUM_DETAILS_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released
+    FROM albums
+    WHERE id = %s;
+    """
+
 
-        
 def get_album_details(album_id):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released
-        FROM albums
-        WHERE id = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (album_id, ))
-            return Album.from_values(cur.fetchone())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    snapshot = catalog.get_snapshot()
+    values = snapshot.get(album_id, width=9) if snapshot else None
+    if values:
+        return Album(*values)
+    return _get_album(ALBUM_DETAILS_SQL, (album_id, ))
     
 
+ALBUM_DETAILS_BY_URL_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released, tags_json
+    FROM albums
+    WHERE url = %s;
+    """
+
+
 def get_album_details_by_url(album_url):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json
-        FROM albums
-        WHERE url = %s;
-        """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (album_url, ))
-            return Album.from_values(cur.fetchone())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get_album(ALBUM_DETAILS_BY_URL_SQL, (album_url, ))
 
 
 def get_album_details_with_tags(album_id):
@@ -309,13 +770,11 @@ def get_album_details_with_tags(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (album_id, ))
-            return Album.from_values(cur.fetchone())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    snapshot = catalog.get_snapshot()
+    values = snapshot.get(album_id, width=10) if snapshot else None
+    if values:
+        return Album(*values)
+    return _get_album(sql, (album_id, ))
 
 
 def get_album_details_from_ids(album_ids):
@@ -324,26 +783,31 @@ def get_album_details_from_ids(album_ids):
         FROM albums 
         WHERE id IN %s;
         """
-    with closing(get_connection()) as conn:        
+    with closing(get_connection(read_only=True)) as conn:        
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_ids, ))
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_by_channel(channel):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released
-        FROM albums
-        WHERE channel = %s
+ALBUMS_BY_CHANNEL_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released
+    FROM albums
+    WHERE channel = %s;
     """
-    with closing(get_connection()) as conn:
+
+
+def get_albums_by_channel(channel):
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        return Album.albums_from_values(snapshot.select(9, channel=channel))
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
-            cur.execute(sql, (channel,))
-            return Album.albums_from_values(cur.fetchall())
+            cur.execute(ALBUMS_BY_CHANNEL_SQL, (channel,))
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -351,14 +815,18 @@ def get_albums_by_channel(channel):
 def set_album_users(album_id, users):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET users_json = %s
-                WHERE id = %s;
+                FROM albums AS old
+                WHERE albums.id = %s AND old.id = albums.id
+                {VERSIONED_WITH_OLD};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps(users), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -366,14 +834,17 @@ def set_album_users(album_id, users):
 def add_user_to_album(album_id, user):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET users_json = users_json || %s
-                WHERE id = %s AND NOT users_json ? %s;
+                WHERE id = %s AND NOT users_json ? %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps([user]), album_id, user))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -381,29 +852,39 @@ def add_user_to_album(album_id, user):
 def remove_user_from_album(album_id, user):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
-                SET users_json = users_json - %s
-                WHERE id = %s;
+                SET users_json = albums.users_json - %s
+                FROM albums AS old
+                WHERE albums.id = %s AND old.id = albums.id
+                {VERSIONED_WITH_OLD};
                 """
             cur = conn.cursor()
             cur.execute(sql, (user, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
+REMOVE_USER_FROM_ALL_ALBUMS_SQL = f"""
+    UPDATE albums
+    SET users_json = albums.users_json - %s
+    FROM albums AS old
+    WHERE albums.users_json ? %s AND old.id = albums.id
+    {VERSIONED_WITH_OLD};
+    """
+
+
 def remove_user_from_all_albums(user):
     with closing(get_connection()) as conn:
         try:
-            sql = """
-                UPDATE albums
-                SET users_json = users_json - %s
-                WHERE users_json ? %s;
-                """
             cur = conn.cursor()
-            cur.execute(sql, (user, user))
+            cur.execute(REMOVE_USER_FROM_ALL_ALBUMS_SQL, (user, user))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -414,22 +895,25 @@ def reset_users():
             cur = conn.cursor()
             cur.execute("UPDATE albums SET users_json = '[]';")
             conn.commit()
+            versions.reset()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
+ALBUMS_BY_USER_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released, tags_json
+    FROM albums
+    WHERE users_json ? %s
+    AND available = true;
+    """
+
+
 def get_albums_by_user(user):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json
-        FROM albums
-        WHERE users_json ? %s
-        AND available = true;
-        """
-    with closing(get_connection()) as conn:
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
-            cur.execute(sql, (user, ))
-            return Album.albums_from_values(cur.fetchall())
+            cur.execute(ALBUMS_BY_USER_SQL, (user, ))
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -440,26 +924,23 @@ def get_album_details_with_users(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, (album_id, ))
-            return Album.from_values(cur.fetchone())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get_album(sql, (album_id, ))
 
 
 def add_user_review_to_album(album_id, user, review):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET reviews_json = reviews_json || %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps([{user: review}]), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -467,14 +948,17 @@ def add_user_review_to_album(album_id, user, review):
 def remove_user_review_from_album(album_id, array_element):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET reviews_json = reviews_json - %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (array_element, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -484,17 +968,11 @@ def get_album_details_with_reviews(album_id):
         FROM albums
         WHERE id = %s;
         """
-    with closing(get_connection()) as conn:
-        try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
-            cur.execute(sql, (album_id, ))
-            return Album.from_values(cur.fetchone())
-        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
+    return _get_album(sql, (album_id, ))
 
 
 def add_to_albums(album_id, artist, name, url, img='', channel=''):
-    sql = """
+    sql = f"""
         INSERT INTO albums (
         id, 
         artist, 
@@ -503,12 +981,15 @@ def add_to_albums(album_id, artist, name, url, img='', channel=''):
         img,
         channel,
         available
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s);"""
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+        {VERSIONED};"""
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
             cur.execute(sql, (album_id, artist, name, url, img, channel, True))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except psycopg2.IntegrityError:
             raise DatabaseError(f'album {album_id} already exists')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
@@ -516,49 +997,82 @@ def add_to_albums(album_id, artist, name, url, img='', channel=''):
 
 
 def add_many_to_albums(albums):
-    sql = """
+    """
+    Bulk insert (id, artist, name, url, img) rows via COPY into a staging
+    table, returning the ids of the albums that were actually new.
+    """
+    sql = f"""
         INSERT INTO albums (
-        id, 
-        artist, 
-        name, 
-        url, 
+        id,
+        artist,
+        name,
+        url,
         img
-        ) VALUES (%s, %s, %s, %s, %s);"""
+        )
+        SELECT DISTINCT ON (id) id, artist, name, url, img
+        FROM albums_staging
+        WHERE id IS NOT NULL
+        ON CONFLICT (id) DO NOTHING
+        {VERSIONED};"""
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.executemany(sql, albums)
+            cur.execute("""
+                CREATE TEMP TABLE albums_staging (
+                id varchar,
+                artist varchar,
+                name varchar,
+                url varchar,
+                img varchar
+                ) ON COMMIT DROP;""")
+            copy_rows(cur, 'albums_staging', ('id', 'artist', 'name', 'url', 'img'), albums)
+            cur.execute(sql)
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
+            return [item[0] for item in changed]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def add_img_to_album(album_id, album_img):
+def add_img_to_album(album_id, album_img, buffered=False):
+    if buffered:
+        update_buffer.push(album_id, 'img', album_img)
+        return
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET img = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (album_img, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def update_album_url(album_id, album_url):
+def update_album_url(album_id, album_url, buffered=False):
+    if buffered:
+        update_buffer.push(album_id, 'url', album_url)
+        return
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET url = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (album_url, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -566,44 +1080,59 @@ def update_album_url(album_id, album_url):
 def add_added_to_album(album_id, dt):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET added = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (dt, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def add_released_to_album(album_id, date):
+def add_released_to_album(album_id, date, buffered=False):
+    if buffered:
+        update_buffer.push(album_id, 'released', date)
+        return
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET released = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (date, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def update_album_availability(album_id, status):
+def update_album_availability(album_id, status, buffered=False):
+    if buffered:
+        update_buffer.push(album_id, 'available', bool(status))
+        return
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET available = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (bool(status), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -611,29 +1140,39 @@ def update_album_availability(album_id, status):
 def update_album_added(album_id, added):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET added = %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (added, album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def set_album_tags(album_id, tags):
+def set_album_tags(album_id, tags, buffered=False):
+    if buffered:
+        update_buffer.push(album_id, 'tags_json', json.dumps(tags))
+        return
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET tags_json = %s
-                WHERE id = %s;
+                FROM albums AS old
+                WHERE albums.id = %s AND old.id = albums.id
+                {VERSIONED_WITH_OLD};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps(tags), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -641,14 +1180,17 @@ def set_album_tags(album_id, tags):
 def add_tag_to_album(album_id, tag):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
                 SET tags_json = tags_json || %s
-                WHERE id = %s;
+                WHERE id = %s
+                {VERSIONED};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps([tag.lower()]), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -656,20 +1198,26 @@ def add_tag_to_album(album_id, tag):
 def remove_tag_from_album(album_id, tag):
     with closing(get_connection()) as conn:
         try:
-            sql = """
+            sql = f"""
                 UPDATE albums
-                SET tags_json = tags_json - %s
-                WHERE id = %s;
+                SET tags_json = albums.tags_json - %s
+                FROM albums AS old
+                WHERE albums.id = %s AND old.id = albums.id
+                {VERSIONED_WITH_OLD};
                 """
             cur = conn.cursor()
             cur.execute(sql, (json.dumps(tag), album_id))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_album_ids():
-    with closing(get_connection()) as conn:
+def get_album_ids(stream=False, itersize=None):
+    if stream:
+        return stream_rows('SELECT id FROM albums;', itersize=itersize, row_factory=lambda values: values[0])
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute('SELECT id FROM albums;')
@@ -678,58 +1226,292 @@ def get_album_ids():
             raise DatabaseError(e)
 
 
-def get_random_album():
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
-        FROM albums 
-        WHERE available = true
-        ORDER BY RANDOM() 
+def random_album_sql(filters):
+    """
+    The query behind get_random_album, for albums matching all of `filters`;
+    it takes the filters' parameters, the random key, and them again.
+    """
+    where = ' AND '.join(filters)
+    return f"""
+        (SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+        FROM albums
+        WHERE {where} AND random_key >= %s
+        ORDER BY random_key
+        LIMIT 1)
+        UNION ALL
+        (SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+        FROM albums
+        WHERE {where}
+        ORDER BY random_key
+        LIMIT 1)
         LIMIT 1;
         """
-    with closing(get_connection()) as conn:
+
+
+def get_random_album(tag=None, channel=None):
+    """
+    Draw a random available album by seeking to a random point in the
+    indexed random_key column (wrapping around to the start if needed)
+    rather than sorting the whole catalog.
+    """
+    filters = ['available = true']
+    params = []
+    if tag:
+        filters.append('tags_json ? %s')
+        params.append(tag)
+    if channel:
+        filters.append('channel = %s')
+        params.append(channel)
+    with closing(get_connection(read_only=True)) as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
-            cur.execute(sql)
-            return Album.from_values(cur.fetchone())
+            cur = conn.cursor()
+            cur.execute(random_album_sql(filters), params + [random.random()] + params)
+            return Album.from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def get_albums_by_tag(tag):
+def get_next_album_in_cycle(cycle):
+    """
+    Step through the available albums in random_key order, remembering the
+    position per named cycle, so that no album repeats until all have been
+    drawn (e.g. for the album of the day).
+    """
     sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json
+        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, users_json, reviews_json, random_key
         FROM albums
-        WHERE tags_json ? %s
-        AND available = true;
+        WHERE available = true AND random_key > %s
+        ORDER BY random_key
+        LIMIT 1;
         """
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute(sql, (tag, ))
-            return Album.albums_from_values(cur.fetchall())
+            cur.execute('INSERT INTO random_cycles (name) VALUES (%s) ON CONFLICT (name) DO NOTHING;', (cycle, ))
+            cur.execute('SELECT position FROM random_cycles WHERE name = %s FOR UPDATE;', (cycle, ))
+            position = cur.fetchone()[0]
+            cur.execute(sql, (position, ))
+            values = cur.fetchone()
+            if values is None:
+                # cycle exhausted, so start the next one from the beginning
+                cur.execute(sql, (-1, ))
+                values = cur.fetchone()
+            if values is None:
+                return None
+            cur.execute('UPDATE random_cycles SET position = %s WHERE name = %s;', (values[-1], cycle))
+            conn.commit()
+            return Album.from_values(values[:-1])
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def search_albums(query):
-    sql = """
-        SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+ALBUMS_BY_TAG_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released, tags_json
+    FROM albums
+    WHERE tags_json ? %s
+    AND available = true;
+    """
+
+
+def get_albums_by_tag(tag):
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        return Album.albums_from_values(snapshot.select(10, tag=tag, available=True))
+    with closing(get_connection(read_only=True)) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(ALBUMS_BY_TAG_SQL, (tag, ))
+            return Album.albums_from_cursor(cur)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+# API field name -> albums column, in the order of Album.to_dict
+ALBUM_FIELDS = {
+    'added': 'added',
+    'album': 'name',
+    'artist': 'artist',
+    'channel': 'channel',
+    'id': 'id',
+    'img': 'img',
+    'released': 'released',
+    'reviews': 'reviews_json',
+    'tags': 'tags_json',
+    'url': 'url',
+    'users': 'users_json',
+}
+
+JSON_FIELDS = {'reviews', 'tags', 'users'}
+
+
+# keyset pages are ordered by (PAGE_ADDED, id): albums without an added
+# date sort as if added at the epoch, rather than dropping out as NULLs
+PAGE_ADDED = "COALESCE(added, 'epoch'::timestamp)"
+
+
+def albums_page_sql(columns, conditions, after=False):
+    """
+    The query behind get_albums_page, selecting the page key and then
+    `columns`; it takes the conditions' parameters, the key of the previous
+    page's last album if `after`, and then the limit.
+    """
+    if after:
+        conditions = conditions + [f'({PAGE_ADDED}, id) > (%s, %s)']
+    return f"""
+        SELECT {', '.join([PAGE_ADDED, 'id'] + list(columns))}
         FROM albums
-        WHERE LOWER(name) LIKE %s 
-        OR LOWER(artist) LIKE %s
-        OR tags_json ? %s
-        AND available = true;
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY {PAGE_ADDED}, id
+        LIMIT %s;
         """
-    with closing(get_connection()) as conn:
+
+
+def get_albums_page(fields=None, limit=100, after=None, channel=None, tag=None):
+    """
+    Keyset-paginate albums ordered by (PAGE_ADDED, id), selecting only the
+    columns behind `fields`. `after` is that key of the last album on the
+    previous page. Returns the page as dicts shaped like
+    Album.to_dict, and the key to pass as `after` for the next page, or
+    None when this was the last one.
+    """
+    fields = [field for field in ALBUM_FIELDS if field in fields] if fields else list(ALBUM_FIELDS)
+    columns = [ALBUM_FIELDS[field] for field in fields]
+    conditions, params = [], []
+    if channel:
+        conditions.append('channel = %s')
+        params.append(channel)
+    if tag:
+        conditions.append('tags_json ? %s AND available = true')
+        params.append(tag)
+    if after:
+        params.extend(after)
+    params.append(limit)
+    with closing(get_connection(read_only=True)) as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
-            term = f'%{query}%'
-            cur.execute(sql, (term, term, query))
-            return Album.albums_from_values(cur.fetchall())
+            cur = conn.cursor()
+            cur.execute(albums_page_sql(columns, conditions, after=bool(after)), params)
+            rows = cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+    albums = []
+    for row in rows:
+        values = dict(zip(columns, row[2:]))
+        album = {}
+        for field in fields:
+            value = values[ALBUM_FIELDS[field]]
+            if field == 'added':
+                album[field] = value.isoformat() if value else ''
+            elif field in JSON_FIELDS:
+                album[field] = value or []
+            else:
+                album[field] = value or ''
+        albums.append(album)
+    next_after = (rows[-1][0], rows[-1][1]) if limit and len(rows) == limit else None
+    return albums, next_after
+
+
+def get_album_details_json(channel=None, tag=None):
+    """
+    Build the `[{id: details}]` JSON of the catalog (or of a channel, or
+    the available albums with a tag) inside Postgres, or from the catalog
+    snapshot, and return it as one string without an Album per row. Matches
+    Album.to_dict for rows with tags but not users or reviews, as
+    get_albums_with_tags.
+    """
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        rows = snapshot.select(10, channel=channel or None, tag=tag or None, available=True if tag else None)
+        return json.dumps([{
+            values[0]: {
+                'added': values[7].strftime('%Y-%m-%dT%H:%M:%S.%f') if values[7] else None,
+                'album': values[1] or '',
+                'artist': values[2] or '',
+                'channel': values[6] or '',
+                'id': values[0],
+                'img': values[4] or '',
+                'released': values[8] or '',
+                'reviews': [],
+                'tags': values[9] or [],
+                'url': values[3] or '',
+                'users': [],
+            }
+        } for values in rows])
+    conditions, params = [], []
+    if channel:
+        conditions.append('channel = %s')
+        params.append(channel)
+    if tag:
+        conditions.append('tags_json ? %s AND available = true')
+        params.append(tag)
+    sql = f"""
+        SELECT COALESCE(json_agg(json_build_object(id, json_build_object(
+            'added', to_char(added, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+            'album', COALESCE(name, ''),
+            'artist', COALESCE(artist, ''),
+            'channel', COALESCE(channel, ''),
+            'id', id,
+            'img', COALESCE(img, ''),
+            'released', COALESCE(released, ''),
+            'reviews', '[]'::json,
+            'tags', COALESCE(tags_json, '[]'),
+            'url', COALESCE(url, ''),
+            'users', '[]'::json
+        ))), '[]')::text
+        FROM albums
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''};
+        """
+    with closing(get_connection(read_only=True)) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchone()[0]
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
+SEARCH_ALBUMS_SQL = """
+    SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
+    FROM albums, to_tsquery('simple', %(tsquery)s) AS tsquery
+    WHERE available = true
+    AND (
+        search_vector @@ tsquery
+        OR LOWER(name) %% %(term)s
+        OR LOWER(artist) %% %(term)s
+        OR LOWER(name) LIKE %(infix)s
+        OR LOWER(artist) LIKE %(infix)s
+    )
+    ORDER BY
+        ts_rank(search_vector, tsquery)
+        + GREATEST(similarity(LOWER(name), %(term)s), similarity(LOWER(artist), %(term)s)) DESC,
+        id
+    LIMIT %(limit)s
+    OFFSET %(offset)s;
+    """
+
+
+def search_albums(query, limit=None, offset=0):
+    """
+    Ranked search over names, artists and tags: prefix full-text matches on
+    the search_vector column, trigram similarity to catch typos, and
+    substrings of names and artists (served by the same trigram indexes).
+    """
+    term = query.lower().strip()
+    params = {
+        'tsquery': ' & '.join(f'{word}:*' for word in re.findall(r'\w+', term)),
+        'term': term,
+        'infix': '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%',
+        'limit': limit,
+        'offset': offset,
+    }
+    with closing(get_connection(read_only=True)) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(SEARCH_ALBUMS_SQL, params)
+            return Album.albums_from_cursor(cur)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError, psycopg2.DataError) as e:
+            raise DatabaseError(e)
+
+
 def search_albums_by_tag(query):
     sql = """
         SELECT id, name, artist, url, img, available, channel, added, released, tags_json, reviews_json
@@ -737,12 +1519,17 @@ def search_albums_by_tag(query):
         WHERE tags_json ? %s
         AND available = true;
         """
-    with closing(get_connection()) as conn:
+    snapshot = catalog.get_snapshot()
+    if snapshot:
+        # users_json is not selected here, so skip over it
+        return (Album(*values[:10], reviews_json=values[11])
+                for values in snapshot.select(tag=query, available=True))
+    with closing(get_connection(read_only=True)) as conn:
         try:
-            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur = conn.cursor()
             # term = f'%{query}%' TODO
             cur.execute(sql, (query, ))
-            return Album.albums_from_values(cur.fetchall())
+            return Album.albums_from_cursor(cur)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -753,6 +1540,7 @@ def _reset_albums():
             cur = conn.cursor()
             cur.execute('DELETE FROM albums')
             conn.commit()
+            versions.reset()
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -761,8 +1549,10 @@ def delete_from_albums(album_id):
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute('DELETE FROM albums where id = %s;', (album_id,))
+            cur.execute(f'DELETE FROM albums where id = %s {VERSIONED};', (album_id,))
+            changed = cur.fetchall()
             conn.commit()
+            versions.bump_albums(changed)
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -771,16 +1561,32 @@ def delete_from_list_and_albums(album_id):
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute('DELETE FROM albums where id = %s;', (album_id,))
+            cur.execute(f'DELETE FROM albums where id = %s {VERSIONED};', (album_id,))
+            changed = cur.fetchall()
             cur.execute('DELETE FROM list where album = %s;', (album_id,))
             conn.commit()
+            versions.bump_albums(changed)
+            versions.bump('list')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
-def check_for_new_albums():
-    return [
-        str(album_id)
-        for album_id in set(get_list()).difference(set(get_album_ids()))
-        if album_id is not None
-    ]
+NEW_ALBUMS_SQL = """
+    SELECT l.album
+    FROM list l
+    LEFT JOIN albums a ON a.id = l.album
+    WHERE a.id IS NULL
+    AND l.album IS NOT NULL
+    AND l.id > %s
+    AND (%s IS NULL OR l.id <= %s);
+    """
+
+
+def check_for_new_albums(since=0, until=None, itersize=None):
+    """
+    Stream the ids of list items (with list.id in (since, until]) that have
+    no album details yet, anti-joining list against albums in Postgres.
+    """
+    # on the primary: a lagging replica would let the watermark skip rows
+    return stream_rows(NEW_ALBUMS_SQL, (since, until, until), itersize=itersize, row_factory=lambda values: values[0],
+                       read_only=False)
@@ -0,0 +1,292 @@
+import collections
+import os
+import threading
+import time
+from contextlib import closing
+
+import psycopg2
+import redis
+
+from albumlist import versions
+from albumlist.models import DatabaseError, get_connection, primary_required
+
+
+# the snapshot's columns, in Album constructor order
+COLUMNS = ('id', 'name', 'artist', 'url', 'img', 'available', 'channel', 'added', 'released',
+           'tags_json', 'users_json', 'reviews_json')
+
+# reads fall back to Postgres once the snapshot is older than this
+MAX_STALENESS = float(os.environ.get('CATALOG_MAX_STALENESS', 30))
+REFRESH_INTERVAL = float(os.environ.get('CATALOG_REFRESH_INTERVAL', 5))
+# a full reload compacts deleted rows away, and recovers from any missed change
+RELOAD_INTERVAL = float(os.environ.get('CATALOG_RELOAD_INTERVAL', 60 * 60))
+# re-read changes this far behind the watermark, for transactions that committed late
+CHANGE_OVERLAP = 60
+
+ALBUM_CHANGES_SQL = """
+    SELECT DISTINCT album_id FROM album_changes
+    WHERE changed > %s - make_interval(secs => %s);
+    """
+
+
+def create_album_changes_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS album_changes (
+        id bigserial PRIMARY KEY,
+        album_id varchar NOT NULL,
+        changed timestamptz NOT NULL DEFAULT clock_timestamp()
+        );
+        CREATE INDEX IF NOT EXISTS album_changes_changed ON album_changes (changed);
+
+        CREATE OR REPLACE FUNCTION log_album_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO album_changes (album_id) VALUES (OLD.id);
+            ELSE
+                INSERT INTO album_changes (album_id) VALUES (NEW.id);
+                IF TG_OP = 'UPDATE' AND NEW.id <> OLD.id THEN
+                    INSERT INTO album_changes (album_id) VALUES (OLD.id);
+                END IF;
+            END IF;
+            -- prune now and then, rather than needing a separate job
+            IF random() < 0.001 THEN
+                DELETE FROM album_changes WHERE changed < now() - interval '1 day';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS albums_log_change ON albums;
+        CREATE TRIGGER albums_log_change
+        AFTER INSERT OR UPDATE OR DELETE ON albums
+        FOR EACH ROW EXECUTE PROCEDURE log_album_change();
+        """
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+class CatalogSnapshot:
+    """
+    The albums table held in memory as one list per column, with id -> row,
+    tag -> rows and channel -> rows indexes. Deleted albums leave a hole
+    (id None) until the next full reload.
+    """
+
+    def __init__(self):
+        self.columns = [[] for _ in COLUMNS]
+        self.rows = {}
+        self.by_tag = collections.defaultdict(set)
+        self.by_channel = collections.defaultdict(set)
+        self.watermark = None
+        # the versions.marker() this snapshot has caught up with, if known
+        self.marker = None
+        self.loaded = time.monotonic()
+        self.refreshed = self.loaded
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _set(self, row, values):
+        if row is None:
+            row = len(self.columns[0])
+            for column in self.columns:
+                column.append(None)
+        else:
+            self._unindex(row)
+        for column, value in zip(self.columns, values):
+            column[row] = value
+        self.rows[values[0]] = row
+        self.by_channel[values[6]].add(row)
+        for tag in values[9] or []:
+            self.by_tag[tag].add(row)
+
+    def _unindex(self, row):
+        self.by_channel[self.columns[6][row]].discard(row)
+        for tag in self.columns[9][row] or []:
+            self.by_tag[tag].discard(row)
+
+    def _delete(self, album_id):
+        row = self.rows.pop(album_id, None)
+        if row is not None:
+            self._unindex(row)
+            for column in self.columns:
+                column[row] = None
+
+    def load(self, cur):
+        # a replica has only what it has replayed, which may be some way behind now()
+        cur.execute("""
+            SELECT CASE WHEN pg_is_in_recovery()
+                THEN COALESCE(pg_last_xact_replay_timestamp(), '-infinity')
+                ELSE now()
+            END;
+            """)
+        self.watermark = cur.fetchone()[0]
+        cur.execute(f'SELECT {", ".join(COLUMNS)} FROM albums;')
+        for values in cur:
+            self._set(None, values)
+        self.refreshed = time.monotonic()
+
+    def apply_changes(self, cur, marker=None):
+        """
+        Re-read the albums changed since the watermark, returning how many.
+        Takes a cursor on the primary, as changes a lagging replica has yet
+        to replay would otherwise fall behind the watermark and be lost, and
+        the versions.marker() taken before it.
+        """
+        cur.execute('SELECT now();')
+        watermark = cur.fetchone()[0]
+        cur.execute(ALBUM_CHANGES_SQL, (self.watermark, CHANGE_OVERLAP))
+        album_ids = [row[0] for row in cur.fetchall()]
+        changed = []
+        if album_ids:
+            cur.execute(f'SELECT {", ".join(COLUMNS)} FROM albums WHERE id = ANY(%s);', (album_ids, ))
+            changed = cur.fetchall()
+        with self._lock:
+            for values in changed:
+                self._set(self.rows.get(values[0]), values)
+            for album_id in set(album_ids).difference(values[0] for values in changed):
+                self._delete(album_id)
+            self.watermark = watermark
+            self.marker = marker
+            self.refreshed = time.monotonic()
+        return len(album_ids)
+
+    def covers(self, marker):
+        """
+        Return whether the snapshot has every write behind the bumps up to
+        `marker`, an (epoch, sequence number) from versions.etag_and_marker.
+        """
+        caught_up = self.marker
+        return caught_up is not None and caught_up[0] == marker[0] and caught_up[1] >= marker[1]
+
+    def get(self, album_id, width=len(COLUMNS)):
+        with self._lock:
+            row = self.rows.get(album_id)
+            if row is None:
+                return None
+            return tuple(column[row] for column in self.columns[:width])
+
+    def select(self, width=len(COLUMNS), channel=None, tag=None, available=None):
+        """
+        Return the rows (as tuples of the first `width` columns) matching
+        all of the given filters.
+        """
+        with self._lock:
+            if channel is not None and tag is not None:
+                rows = self.by_channel.get(channel, set()) & self.by_tag.get(tag, set())
+            elif channel is not None:
+                rows = self.by_channel.get(channel, set())
+            elif tag is not None:
+                rows = self.by_tag.get(tag, set())
+            else:
+                rows = self.rows.values()
+            if available is not None:
+                rows = [row for row in rows if self.columns[5][row] is available]
+            columns = self.columns[:width]
+            return [tuple(column[row] for column in columns) for row in sorted(rows)]
+
+
+_enabled = False
+_disabled = False
+_snapshot = None
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = not _disabled
+
+
+def disable():
+    """
+    Keep the snapshot off in this process (and its children), even if
+    enable() is called later, as it is when the queue daemon creates the app.
+    """
+    global _enabled, _disabled
+    _enabled = False
+    _disabled = True
+
+
+def refresh():
+    """
+    Bring the snapshot up to date: incrementally from album_changes, or with
+    a full reload if there is no snapshot yet or it is due one.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    reload = snapshot is None or time.monotonic() - snapshot.loaded > RELOAD_INTERVAL
+    # full reloads can come from the replica, but changes are read from the primary,
+    # after the marker: a replica load only catches up with it at the next refresh
+    marker = None
+    if not reload:
+        try:
+            marker = versions.marker()
+        except redis.RedisError as e:
+            print(f'[catalog]: failed to get versions: {e}')
+    with closing(get_connection(read_only=reload)) as conn:
+        try:
+            cur = conn.cursor()
+            if reload:
+                snapshot = CatalogSnapshot()
+                snapshot.load(cur)
+                _snapshot = snapshot
+                print(f'[catalog]: loaded {len(snapshot)} albums')
+            else:
+                snapshot.apply_changes(cur, marker)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def _refresh_forever():
+    while True:
+        try:
+            refresh()
+        except (DatabaseError, psycopg2.Error) as e:
+            print(f'[catalog]: failed to refresh: {e}')
+        time.sleep(REFRESH_INTERVAL)
+
+
+def get_snapshot():
+    """
+    Return this process's snapshot if it is enabled and no more than
+    MAX_STALENESS seconds behind, otherwise None so that the caller reads
+    Postgres. Callers that need the primary only get it if it has caught
+    up with their etagged view's tag. The first call in each process starts
+    its refresher thread.
+    """
+    global _refresher
+    if not _enabled:
+        return None
+    # threads don't survive a fork, so each gunicorn worker starts its own
+    if _refresher is None or _refresher.pid != os.getpid():
+        with _refresher_lock:
+            if _refresher is None or _refresher.pid != os.getpid():
+                _refresher = threading.Thread(target=_refresh_forever, name='catalog-refresh', daemon=True)
+                _refresher.pid = os.getpid()
+                _refresher.start()
+    snapshot = _snapshot
+    if snapshot is None or time.monotonic() - snapshot.refreshed > MAX_STALENESS:
+        return None
+    if primary_required():
+        marker = versions.request_marker()
+        if marker is None or not snapshot.covers(marker):
+            return None
+    return snapshot
+
+
+def get_stats():
+    snapshot = _snapshot
+    if snapshot is None:
+        return {'enabled': _enabled, 'albums': None, 'age': None}
+    return {
+        'enabled': _enabled,
+        'albums': len(snapshot),
+        'age': round(time.monotonic() - snapshot.refreshed, 3),
+    }
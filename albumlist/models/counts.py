@@ -0,0 +1,175 @@
+from contextlib import closing
+
+import psycopg2
+
+from albumlist.models import DatabaseError, get_connection
+
+
+COUNTERS = {
+    'list': 'SELECT COUNT(*) FROM list;',
+    'albums': 'SELECT COUNT(*) FROM albums;',
+    'albums_unavailable': 'SELECT COUNT(*) FROM albums WHERE available IS FALSE;',
+}
+
+ESTIMATE_TABLES = {
+    'list': 'list',
+    'albums': 'albums',
+}
+
+# each counter is summed from this many rows, and each connection's triggers
+# update one of them, so concurrent writers don't queue on a single row lock
+COUNT_SHARDS = 8
+
+
+def create_counts_table():
+    """
+    Install the counting triggers and seed the totals. This locks list and
+    albums and counts them, so it only runs once, as migration 6.
+    """
+    sql = """
+        CREATE TABLE IF NOT EXISTS counts (
+        name varchar PRIMARY KEY,
+        value bigint NOT NULL DEFAULT 0
+        );
+
+        CREATE OR REPLACE FUNCTION count_list_rows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE counts SET value = value + 1 WHERE name = 'list';
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE counts SET value = value - 1 WHERE name = 'list';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION count_albums_rows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE counts SET value = value + 1 WHERE name = 'albums';
+                IF NEW.available IS FALSE THEN
+                    UPDATE counts SET value = value + 1 WHERE name = 'albums_unavailable';
+                END IF;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE counts SET value = value - 1 WHERE name = 'albums';
+                IF OLD.available IS FALSE THEN
+                    UPDATE counts SET value = value - 1 WHERE name = 'albums_unavailable';
+                END IF;
+            ELSIF (NEW.available IS FALSE) <> (OLD.available IS FALSE) THEN
+                UPDATE counts
+                SET value = value + CASE WHEN NEW.available IS FALSE THEN 1 ELSE -1 END
+                WHERE name = 'albums_unavailable';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        LOCK TABLE list, albums IN SHARE ROW EXCLUSIVE MODE;
+
+        DROP TRIGGER IF EXISTS list_count ON list;
+        CREATE TRIGGER list_count
+        AFTER INSERT OR DELETE ON list
+        FOR EACH ROW EXECUTE PROCEDURE count_list_rows();
+
+        DROP TRIGGER IF EXISTS albums_count ON albums;
+        CREATE TRIGGER albums_count
+        AFTER INSERT OR DELETE OR UPDATE OF available ON albums
+        FOR EACH ROW EXECUTE PROCEDURE count_albums_rows();
+        """
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            # seed the counters while the tables are locked against writes
+            for name, count_sql in COUNTERS.items():
+                cur.execute(count_sql)
+                cur.execute("""
+                    INSERT INTO counts (name, value) VALUES (%s, %s)
+                    ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;
+                    """, (name, cur.fetchone()[0]))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def shard_counts_table():
+    """
+    Spread each counter over COUNT_SHARDS rows. The existing totals become
+    shard 0, so nothing is recounted and no table is locked but counts.
+    """
+    sql = f"""
+        ALTER TABLE counts ADD COLUMN shard smallint NOT NULL DEFAULT 0;
+        ALTER TABLE counts DROP CONSTRAINT IF EXISTS counts_pkey;
+        ALTER TABLE counts ADD PRIMARY KEY (name, shard);
+
+        INSERT INTO counts (name, shard, value)
+        SELECT name, shard, 0
+        FROM (SELECT DISTINCT name FROM counts) AS names, generate_series(0, {COUNT_SHARDS - 1}) AS shard
+        ON CONFLICT (name, shard) DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION count_shard() RETURNS smallint AS $$
+            SELECT (pg_backend_pid() % {COUNT_SHARDS})::smallint;
+        $$ LANGUAGE sql STABLE;
+
+        CREATE OR REPLACE FUNCTION count_list_rows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE counts SET value = value + 1 WHERE name = 'list' AND shard = count_shard();
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE counts SET value = value - 1 WHERE name = 'list' AND shard = count_shard();
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION count_albums_rows() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE counts SET value = value + 1 WHERE name = 'albums' AND shard = count_shard();
+                IF NEW.available IS FALSE THEN
+                    UPDATE counts SET value = value + 1 WHERE name = 'albums_unavailable' AND shard = count_shard();
+                END IF;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE counts SET value = value - 1 WHERE name = 'albums' AND shard = count_shard();
+                IF OLD.available IS FALSE THEN
+                    UPDATE counts SET value = value - 1 WHERE name = 'albums_unavailable' AND shard = count_shard();
+                END IF;
+            ELSIF (NEW.available IS FALSE) <> (OLD.available IS FALSE) THEN
+                UPDATE counts
+                SET value = value + CASE WHEN NEW.available IS FALSE THEN 1 ELSE -1 END
+                WHERE name = 'albums_unavailable' AND shard = count_shard();
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_count(name, estimated=False):
+    """
+    Read a trigger-maintained counter (the sum of its few shard rows). With
+    `estimated`, read the planner's row estimate from pg_class instead,
+    where there is one.
+    """
+    with closing(get_connection(read_only=True)) as conn:
+        try:
+            cur = conn.cursor()
+            if estimated and name in ESTIMATE_TABLES:
+                cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass;",
+                            (ESTIMATE_TABLES[name], ))
+            else:
+                cur.execute('SELECT SUM(value)::bigint FROM counts WHERE name = %s;', (name, ))
+            row = cur.fetchone()
+            if row[0] is None or row[0] < 0:
+                cur.execute(COUNTERS[name])
+                row = cur.fetchone()
+            return row[0]
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
@@ -1,9 +1,10 @@
-import collections
+import time
 from contextlib import closing
 
 import psycopg2
 
-from albumlist.models import DatabaseError, get_connection
+from albumlist import versions
+from albumlist.models import DatabaseError, copy_rows, counts, get_connection
 
 
 def create_list_table():
@@ -16,8 +17,79 @@ def create_list_table():
             raise DatabaseError(e)
 
 
-def get_list():
+def create_list_watermarks_table():
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS list_watermarks (
+                name varchar PRIMARY KEY,
+                list_id integer NOT NULL DEFAULT 0
+                );""")
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_list_watermark(name):
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT list_id FROM list_watermarks WHERE name = %s;', (name,))
+            row = cur.fetchone()
+            return row[0] if row else 0
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def set_list_watermark(name, list_id):
+    sql = """
+        INSERT INTO list_watermarks (name, list_id) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET list_id = GREATEST(list_watermarks.list_id, EXCLUDED.list_id);
+        """
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (name, list_id))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_settled_list_id(wait=5.0, interval=0.1):
+    """
+    Return the highest list id at or below which every insert has committed
+    or rolled back, to move a watermark to, or None if the list was being
+    written to throughout the `wait` seconds. Serial ids are taken before
+    commit, so MAX(id) alone can pass over a row that is still being added;
+    but any such row's transaction holds its lock on the list until it ends.
+    """
+    sql = """
+        SELECT COALESCE(MAX(id), 0), EXISTS (
+            SELECT 1 FROM pg_locks
+            WHERE relation = 'list'::regclass AND mode = 'RowExclusiveLock' AND pid <> pg_backend_pid()
+        )
+        FROM list;
+        """
+    deadline = time.monotonic() + wait
     with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            while True:
+                cur.execute(sql)
+                list_id, writing = cur.fetchone()
+                conn.rollback()
+                if not writing:
+                    return list_id
+                if time.monotonic() > deadline:
+                    return None
+                time.sleep(interval)
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_list():
+    with closing(get_connection(read_only=True)) as conn:
         try:
             cur = conn.cursor()
             cur.execute('SELECT album FROM list;')
@@ -26,34 +98,65 @@ def get_list():
             raise DatabaseError(e)
 
 
-def get_list_count():
+def get_list_count(estimated=False):
+    return counts.get_count('list', estimated=estimated)
+
+
+IS_IN_LIST_SQL = 'SELECT 1 FROM list WHERE album = %s LIMIT 1;'
+
+
+def is_in_list(album_id):
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute('SELECT album FROM list;')
-            return cur.rowcount
+            cur.execute(IS_IN_LIST_SQL, (album_id,))
+            return cur.fetchone() is not None
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def add_to_list(album_id):
+    """
+    Add an album id to the list, returning False if it was already there.
+    """
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.execute('INSERT INTO list (album) VALUES (%s)', (album_id,))
+            cur.execute('INSERT INTO list (album) VALUES (%s) ON CONFLICT (album) DO NOTHING RETURNING album;',
+                        (album_id,))
+            added = cur.fetchone() is not None
             conn.commit()
-        except psycopg2.IntegrityError:
-            raise DatabaseError(f'list item {album_id} already exists')
+            if added:
+                versions.bump('list')
+            return added
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def add_many_to_list(album_ids):
+    """
+    Bulk insert (album_id,) rows via COPY into a staging table, returning
+    the ids that were not already in the list.
+    """
+    sql = """
+        INSERT INTO list (album)
+        SELECT DISTINCT s.album
+        FROM list_staging s
+        WHERE s.album IS NOT NULL
+        ON CONFLICT (album) DO NOTHING
+        RETURNING album;
+        """
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.executemany('INSERT INTO list (album) VALUES (%s)', album_ids)
+            cur.execute('CREATE TEMP TABLE list_staging (album varchar) ON COMMIT DROP;')
+            copy_rows(cur, 'list_staging', ('album',), album_ids)
+            cur.execute(sql)
+            new_album_ids = [item[0] for item in cur.fetchall()]
             conn.commit()
+            if new_album_ids:
+                versions.bump('list')
+            return new_album_ids
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
@@ -64,20 +167,32 @@ def delete_from_list(album_id):
             cur = conn.cursor()
             cur.execute('DELETE FROM list where album = %s;', (album_id,))
             conn.commit()
+            versions.bump('list')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def check_for_new_list_ids(results):
-    return [
-        (str(album_id),)
-        for album_id in set(
-            results
-        ).difference(
-            set(get_list())
-        )
-        if album_id is not None
-    ]
+    """
+    Anti-join the given album ids against the list, returning (album_id,)
+    rows for those not already in it.
+    """
+    sql = """
+        SELECT DISTINCT s.album
+        FROM unnest(%s::varchar[]) AS s (album)
+        WHERE s.album IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM list l WHERE l.album = s.album);
+        """
+    album_ids = [str(album_id) for album_id in results if album_id is not None]
+    if not album_ids:
+        return []
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, (album_ids,))
+            return cur.fetchall()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
 
 
 def _reset_list():
@@ -86,21 +201,20 @@ def _reset_list():
             cur = conn.cursor()
             cur.execute('DELETE FROM list')
             conn.commit()
+            versions.bump('list')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
             raise DatabaseError(e)
 
 
 def de_dup():
-    duplicates = [
-        (album_id, )
-        for album_id, count in collections.Counter(get_list()).items()
-        if count > 1
-    ]
+    """
+    Remove duplicate list entries, keeping the earliest row for each album.
+    """
     with closing(get_connection()) as conn:
         try:
             cur = conn.cursor()
-            cur.executemany('DELETE FROM list where album = %s;', duplicates)
-            cur.executemany('INSERT INTO list (album) VALUES (%s)', duplicates)
+            cur.execute('DELETE FROM list a USING list b WHERE a.album = b.album AND a.id > b.id;')
             conn.commit()
+            versions.bump('list')
         except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
-            raise DatabaseError(e)
\ No newline at end of file
+            raise DatabaseError(e)
@@ -0,0 +1,218 @@
+import collections
+from contextlib import closing
+
+import psycopg2
+
+from albumlist.models import DatabaseError, get_connection
+from albumlist.models import albums as albums_model, catalog as catalog_model, counts as counts_model, list as list_model
+
+
+# arbitrary key for the advisory lock that stops two releases migrating at once
+MIGRATIONS_LOCK = 7045871
+
+
+Migration = collections.namedtuple('Migration', 'version name apply')
+
+
+def create_index_concurrently(name, definition, unique=False):
+    """
+    Build an index without locking out writes. CONCURRENTLY cannot run in
+    a transaction, and a failed build leaves an invalid index behind that
+    IF NOT EXISTS would skip, so that is dropped first.
+    """
+    def apply():
+        with closing(get_connection()) as conn:
+            conn.autocommit = True
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);', (name, ))
+                row = cur.fetchone()
+                if row and not row[0]:
+                    cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+                cur.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition};')
+            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+            finally:
+                conn.autocommit = False
+    return apply
+
+
+def drop_index_concurrently(name):
+    def apply():
+        with closing(get_connection()) as conn:
+            conn.autocommit = True
+            try:
+                conn.cursor().execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+            except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+                raise DatabaseError(e)
+            finally:
+                conn.autocommit = False
+    return apply
+
+
+def make_list_album_unique():
+    list_model.de_dup()
+    create_index_concurrently('list_album_key', 'list (album)', unique=True)()
+    drop_index_concurrently('list_album')()
+
+
+def create_indexes_concurrently(*indexes):
+    def apply():
+        for name, definition in indexes:
+            create_index_concurrently(name, definition)()
+    return apply
+
+
+def add_albums_random_key():
+    albums_model.create_albums_random_key()
+    create_indexes_concurrently(
+        ('alb_random_key', 'albums (random_key) WHERE available = true'),
+        ('alb_channel_random_key', 'albums (channel, random_key) WHERE available = true'),
+    )()
+
+
+def add_albums_search():
+    albums_model.create_albums_search()
+    create_indexes_concurrently(
+        ('alb_search_vector', 'albums USING gin (search_vector)'),
+        ('alb_trgm_name', 'albums USING gin (LOWER(name) gin_trgm_ops)'),
+        ('alb_trgm_artist', 'albums USING gin (LOWER(artist) gin_trgm_ops)'),
+    )()
+
+
+MIGRATIONS = [
+    Migration(1, 'create list table', list_model.create_list_table),
+    Migration(2, 'create albums table', albums_model.create_albums_table),
+    Migration(3, 'index albums by lower(name)', albums_model.create_albums_index),
+    Migration(4, 'add albums random_key', add_albums_random_key),
+    Migration(5, 'add albums search_vector', add_albums_search),
+    Migration(6, 'create counts table', counts_model.create_counts_table),
+    Migration(7, 'index album and list lookups', create_indexes_concurrently(
+        ('alb_url', 'albums (url)'),
+        ('alb_channel', 'albums (channel)'),
+        ('alb_tags', 'albums USING gin (tags_json)'),
+        ('alb_users', 'albums USING gin (users_json)'),
+        ('alb_unavailable', 'albums (id) WHERE available = false'),
+        ('alb_without_cover', "albums (id) WHERE img = ''"),
+        ('list_album', 'list (album)'),
+    )),
+    Migration(8, 'make list.album unique', make_list_album_unique),
+    Migration(9, 'create list watermarks table', list_model.create_list_watermarks_table),
+    Migration(10, 'index albums by (added or epoch, id) for keyset pages', create_indexes_concurrently(
+        ('alb_page_key', f'albums (({albums_model.PAGE_ADDED}), id)'),
+        ('alb_channel_page_key', f'albums (channel, ({albums_model.PAGE_ADDED}), id)'),
+    )),
+    Migration(11, 'log album changes for catalog snapshots', catalog_model.create_album_changes_table),
+    Migration(12, 'shard counts rows', counts_model.shard_counts_table),
+]
+
+
+# model queries that should be able to use an index, with example parameters
+INDEXED_QUERIES = [
+    ('get_album_details', albums_model.ALBUM_DETAILS_SQL, ('0', )),
+    ('get_album_details_by_url', albums_model.ALBUM_DETAILS_BY_URL_SQL, ('', )),
+    ('get_albums_by_channel', albums_model.ALBUMS_BY_CHANNEL_SQL, ('', )),
+    ('get_albums_by_tag', albums_model.ALBUMS_BY_TAG_SQL, ('', )),
+    ('get_albums_by_user', albums_model.ALBUMS_BY_USER_SQL, ('', )),
+    ('remove_user_from_all_albums', albums_model.REMOVE_USER_FROM_ALL_ALBUMS_SQL, ('', '')),
+    ('get_albums_unavailable', albums_model.ALBUMS_UNAVAILABLE_SQL, ()),
+    ('get_albums_without_covers', albums_model.ALBUMS_WITHOUT_COVERS_SQL, ()),
+    ('get_random_album', albums_model.random_album_sql(['available = true']), (0.5, )),
+    ('get_random_album (tag)', albums_model.random_album_sql(['available = true', 'tags_json ? %s']),
+     ('', 0.5, '')),
+    ('get_albums_page', albums_model.albums_page_sql(['added'], [], after=True), ('2000-01-01', '0', 100)),
+    ('get_albums_page (channel)', albums_model.albums_page_sql(['added'], ['channel = %s'], after=True),
+     ('', '2000-01-01', '0', 100)),
+    ('search_albums', albums_model.SEARCH_ALBUMS_SQL,
+     {'tsquery': 'abc:*', 'term': 'abc', 'infix': '%abc%', 'limit': 20, 'offset': 0}),
+    ('is_in_list', list_model.IS_IN_LIST_SQL, ('0', )),
+    ('check_for_new_albums', albums_model.NEW_ALBUMS_SQL, (0, None, None)),
+    ('catalog snapshot changes', catalog_model.ALBUM_CHANGES_SQL, ('2000-01-01T00:00:00+00:00', 60)),
+]
+
+
+def create_migrations_table():
+    sql = """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name varchar NOT NULL,
+        applied timestamp DEFAULT now()
+        );"""
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def get_applied_versions():
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT version FROM schema_migrations;')
+            return {row[0] for row in cur.fetchall()}
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def record_migration(migration):
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s);',
+                        (migration.version, migration.name))
+            conn.commit()
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+
+
+def run_migrations():
+    """
+    Apply any migrations not yet recorded in schema_migrations, in order,
+    returning the versions applied. Each is recorded as soon as it succeeds.
+    """
+    create_migrations_table()
+    with closing(get_connection()) as lock_conn:
+        lock_conn.autocommit = True
+        try:
+            lock_conn.cursor().execute('SELECT pg_advisory_lock(%s);', (MIGRATIONS_LOCK, ))
+            applied = get_applied_versions()
+            pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+            for migration in pending:
+                print(f'[db]: applying migration {migration.version}: {migration.name}')
+                migration.apply()
+                record_migration(migration)
+            return [migration.version for migration in pending]
+        finally:
+            lock_conn.cursor().execute('SELECT pg_advisory_unlock(%s);', (MIGRATIONS_LOCK, ))
+            lock_conn.autocommit = False
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def verify_indexes():
+    """
+    EXPLAIN each of INDEXED_QUERIES (the models' own SQL, so the check
+    follows the queries as they change) with sequential scans disabled, so
+    that small tables don't hide a missing index, and return (name, index
+    names) pairs, where an empty list means the query could not use an index.
+    """
+    results = []
+    with closing(get_connection()) as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute('SET LOCAL enable_seqscan = off;')
+            for name, sql, params in INDEXED_QUERIES:
+                cur.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cur.fetchone()[0][0]['Plan']
+                indexes = [node['Index Name'] for node in _plan_nodes(plan) if 'Index Name' in node]
+                results.append((name, indexes))
+        except (psycopg2.ProgrammingError, psycopg2.InternalError) as e:
+            raise DatabaseError(e)
+    return results
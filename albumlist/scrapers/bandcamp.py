@@ -38,15 +38,19 @@ def scrape_bandcamp_album_ids_from_url(url, force=False):
 scrape_bandcamp_album_ids_from_url_forced = functools.partial(scrape_bandcamp_album_ids_from_url, force=True)
 
 
+def parse_album_cover_url(content):
+    html = lxh.fromstring(content)
+    try:
+        img = html.cssselect('div#tralbumArt')[0].cssselect('img')[0]
+        return img.attrib['src']
+    except (IndexError, KeyError):
+        raise NotFoundError
+
+
 def scrape_bandcamp_album_cover_url_from_url(url):
     response = requests.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            img = html.cssselect('div#tralbumArt')[0].cssselect('img')[0]
-            return img.attrib['src']
-        except (IndexError, KeyError):
-            raise NotFoundError
+        return parse_album_cover_url(response.text)
     raise NotFoundError
 
 
@@ -61,14 +65,18 @@ def scrape_bandcamp_album_ids_from_artist_page(url):
     raise NotFoundError
 
 
+def parse_tags(content):
+    html = lxh.fromstring(content)
+    try:
+        return [element.text for element in html.cssselect('a.tag')]
+    except AttributeError:
+        return []
+
+
 def scrape_bandcamp_tags_from_url(url):
     response = requests.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            return [element.text for element in html.cssselect('a.tag')]
-        except AttributeError:
-            pass
+        return parse_tags(response.text)
     return []
 
 
@@ -87,15 +95,22 @@ def scrape_bandcamp_album_ids_from_messages(messages, do_requests=True):
                     continue
 
 
+EMBEDDED_PLAYER_URL = 'https://bandcamp.com/EmbeddedPlayer/v=2/album=%s'
+
+
+def parse_album_details(content):
+    html = lxh.fromstring(content)
+    try:
+        data = json.loads(html.xpath('//@data-player-data')[0])
+        return data['album_title'], data['artist'], data['linkback']
+    except (KeyError, TypeError, ValueError):
+        pass
+
+
 def scrape_bandcamp_album_details_from_id(album_id):
-    response = requests.get('https://bandcamp.com/EmbeddedPlayer/v=2/album=%s' % album_id)
+    response = requests.get(EMBEDDED_PLAYER_URL % album_id)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            data = json.loads(html.xpath('//@data-player-data')[0])
-            return data['album_title'], data['artist'], data['linkback']
-        except (KeyError, TypeError, ValueError):
-            pass
+        return parse_album_details(response.text)
 
 
 def scrape_bandcamp_album_details_from_search(query):
@@ -115,14 +130,18 @@ def scrape_bandcamp_album_details_from_search(query):
         raise NotFoundError
 
 
+def parse_album_released(content):
+    html = lxh.fromstring(content)
+    try:
+        data = html.cssselect('div.tralbum-credits')[0].cssselect('meta')[0].attrib
+        if data['itemprop'] == 'datePublished':
+            return data['content']  # YYYYMMDD
+    except (IndexError, KeyError):
+        raise NotFoundError
+
+
 def scrape_bandcamp_album_released_from_url(url):
     response = requests.get(url)
     if response.ok:
-        html = lxh.fromstring(response.text)
-        try:
-            data = html.cssselect('div.tralbum-credits')[0].cssselect('meta')[0].attrib
-            if data['itemprop'] == 'datePublished':
-                return data['content']  # YYYYMMDD
-        except (IndexError, KeyError):
-            raise NotFoundError
+        return parse_album_released(response.text)
     raise NotFoundError
@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+import aiohttp
+
+from albumlist.scrapers import NotFoundError
+from albumlist.scrapers import bandcamp
+
+
+# outbound requests kept in flight at once by one Fetcher
+MAX_IN_FLIGHT = int(os.environ.get('SCRAPER_MAX_IN_FLIGHT', 200))
+REQUEST_TIMEOUT = float(os.environ.get('SCRAPER_REQUEST_TIMEOUT', 30))
+
+
+class Fetcher:
+    """
+    One aiohttp session (so one pool of keep-alive connections) shared by
+    all of a worker's scrapes, with a semaphore bounding the requests in
+    flight. Use as an async context manager.
+    """
+
+    def __init__(self, limit=MAX_IN_FLIGHT, timeout=REQUEST_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.session = None
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get(self, url):
+        """
+        Return the body of a successful GET, or None.
+        """
+        async with self._semaphore:
+            async with self.session.get(url) as response:
+                if response.status < 400:
+                    return await response.text()
+
+    async def head(self, url):
+        async with self._semaphore:
+            async with self.session.head(url, allow_redirects=False) as response:
+                return response.status
+
+
+async def scrape_bandcamp_album_cover_url_from_url(fetcher, url):
+    content = await fetcher.get(url)
+    if content is None:
+        raise NotFoundError
+    return bandcamp.parse_album_cover_url(content)
+
+
+async def scrape_bandcamp_tags_from_url(fetcher, url):
+    content = await fetcher.get(url)
+    if content is None:
+        return []
+    return bandcamp.parse_tags(content)
+
+
+async def scrape_bandcamp_album_details_from_id(fetcher, album_id):
+    content = await fetcher.get(bandcamp.EMBEDDED_PLAYER_URL % album_id)
+    if content is not None:
+        return bandcamp.parse_album_details(content)
+
+
+async def scrape_bandcamp_album_released_from_url(fetcher, url):
+    content = await fetcher.get(url)
+    if content is None:
+        raise NotFoundError
+    return bandcamp.parse_album_released(content)
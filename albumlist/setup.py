@@ -6,8 +6,11 @@ import flask
 from flask_cacheify import init_cacheify
 from pathlib import Path
 
-from albumlist.models import DatabaseError
-from albumlist.models import albums as albums_model, list as list_model
+from albumlist import cache
+from albumlist.cache import ResponseCache
+from albumlist.delayed import redis_connection
+from albumlist.models import catalog
+from albumlist.models import albums as albums_model
 
 
 def add_blueprints(application):
@@ -24,15 +27,6 @@ def add_blueprints(application):
     slack_blueprint.config = application.config.copy()
 
 
-def create_tables(app):
-    try:
-        list_model.create_list_table()
-        albums_model.create_albums_table()
-        albums_model.create_albums_index()
-    except DatabaseError as e:
-        app.logger.error(f'[db]: ERROR - {e}')
-
-
 def create_app():
     TEMPLATE_DIR = Path(__file__).parent.joinpath('templates')
     
@@ -46,29 +40,22 @@ def create_app():
     LIST_NAME = app.config['LIST_NAME']
     _ = app.config['APP_TOKENS']
 
-    create_tables(app)
-
     add_blueprints(app)
 
+    if app.config['CATALOG_SNAPSHOT']:
+        catalog.enable()
+
     app.cache = init_cacheify(app)
+    app.response_cache = ResponseCache(redis_connection)
 
     app.db_error_message = f'{LIST_NAME} error - check with admin'
     app.not_found_message = f'Album not found in the {LIST_NAME}'
 
-    def get_and_set_album_details(album_id):
-        try:
-            details = albums_model.get_album_details(album_id)
-        except DatabaseError as e:
-            flask.current_app.cache.delete('alb-' + album_id)
-            raise e
-        else:
-            flask.current_app.cache.set('alb-' + album_id, details, 60 * 15)
-        return details
-
     def get_cached_album_details(album_id):
-        return flask.current_app.cache.get('alb-' + album_id) or flask.current_app.get_and_set_album_details(album_id)
+        return cache.cached(flask.current_app.cache, 'alb-' + album_id,
+                            lambda: albums_model.get_album_details(album_id),
+                            scopes=['album:' + album_id])
 
-    app.get_and_set_album_details = get_and_set_album_details
     app.get_cached_album_details = get_cached_album_details
 
     app.logger.info(f'[app]: created with {os.environ["APP_SETTINGS"]}')
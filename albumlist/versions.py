@@ -0,0 +1,200 @@
+import functools
+import json
+import uuid
+
+import flask
+import redis
+
+from albumlist.delayed import redis_connection
+from albumlist.models import use_primary
+
+
+# a Redis hash of scope -> version counter, plus an epoch that changes whenever
+# the counters can't be trusted (a reset, or Redis losing the hash), a sequence
+# number counting every bump, and bumped:<scope> -> the sequence number of the
+# scope's last bump (so that the catalog snapshot can tell if it has caught up)
+VERSIONS_KEY = 'catalog-versions'
+
+# versioned cache entries are overwritten in place by each new version (rather
+# than a new key per version), so this only bounds how long unused ones stay
+VERSIONED_TTL = 60 * 60 * 12
+
+# bumped scopes are published here (as a JSON list, or ["*"] for a reset) for
+# the per-process caches in front of Redis
+INVALIDATIONS_CHANNEL = 'catalog-invalidations'
+
+
+# atomically, so that a scope's bumped:<scope> is never behind its last bump
+BUMP = redis_connection.register_script("""
+    local seq = redis.call('hincrby', KEYS[1], 'seq', 1)
+    for _, scope in ipairs(ARGV) do
+        redis.call('hincrby', KEYS[1], scope, 1)
+        redis.call('hset', KEYS[1], 'bumped:' .. scope, seq)
+    end
+    return seq
+    """)
+
+
+def bump(*scopes):
+    """
+    Increment the version counters of the given scopes, e.g. 'albums',
+    'album:<id>', 'channel:<id>', 'tag:<tag>', 'user:<id>' or 'list'.
+    """
+    if not scopes:
+        return
+    try:
+        pipe = redis_connection.pipeline(transaction=False)
+        BUMP(keys=[VERSIONS_KEY], args=sorted(set(scopes)), client=pipe)
+        pipe.publish(INVALIDATIONS_CHANNEL, json.dumps(sorted(set(scopes))))
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f'[versions]: failed to bump {", ".join(scopes)}: {e}')
+
+
+def bump_albums(rows):
+    """
+    Bump 'albums' and the album, channel, tag and user scopes of the given
+    (id, channel, tags, users) rows, as returned by album writes.
+    """
+    scopes = set()
+    for album_id, channel, tags, users in rows:
+        scopes.add(f'album:{album_id}')
+        scopes.add(f'channel:{channel or ""}')
+        scopes.update(f'tag:{tag}' for tag in tags or [])
+        scopes.update(f'user:{user}' for user in users or [])
+    if scopes:
+        bump('albums', *scopes)
+
+
+def reset():
+    """
+    Invalidate every version at once, for bulk writes that touch too much
+    to enumerate.
+    """
+    try:
+        pipe = redis_connection.pipeline(transaction=False)
+        pipe.hset(VERSIONS_KEY, 'epoch', uuid.uuid4().hex[:8])
+        pipe.publish(INVALIDATIONS_CHANNEL, json.dumps(['*']))
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f'[versions]: failed to reset: {e}')
+
+
+def _get_versions(fields):
+    values = redis_connection.hmget(VERSIONS_KEY, 'epoch', *fields)
+    if values[0] is None:
+        redis_connection.hsetnx(VERSIONS_KEY, 'epoch', uuid.uuid4().hex[:8])
+        values = redis_connection.hmget(VERSIONS_KEY, 'epoch', *fields)
+    return [value.decode() if value else '0' for value in values]
+
+
+def etag(*scopes):
+    """
+    Join the current versions of `scopes` into one tag, for ETags and to
+    check cached values against. Values cached under a tag should be built
+    with use_primary(), as a replica may not yet show the write behind the
+    bump (the catalog snapshot is only used once it has caught up, see
+    marker()).
+    """
+    return '-'.join(_get_versions(scopes))
+
+
+def etag_and_marker(*scopes):
+    """
+    Return etag(*scopes) and the (epoch, sequence number) of the last bump
+    of any of `scopes`, which a snapshot must have caught up with to build
+    values for the tag.
+    """
+    values = _get_versions([*scopes, *(f'bumped:{scope}' for scope in scopes)])
+    tag = '-'.join(values[:len(scopes) + 1])
+    return tag, (values[0], max(map(int, values[len(scopes) + 1:]), default=0))
+
+
+def marker():
+    """
+    Return the current (epoch, sequence number), or None if the versions
+    have been lost. Taken before reading the primary, it marks the bumps
+    whose writes the read is sure to see, as albums are bumped after their
+    writes commit.
+    """
+    epoch, seq = redis_connection.hmget(VERSIONS_KEY, 'epoch', 'seq')
+    if epoch is None:
+        return None
+    return epoch.decode(), int(seq or 0)
+
+
+def request_marker():
+    """
+    Return the marker that the snapshot must have caught up with to answer
+    the current request, if it is an etagged view's, or None.
+    """
+    if flask.has_request_context():
+        return flask.g.get('etag_marker')
+    return None
+
+
+def request_etag(scopes):
+    """
+    Return the tag the current request is being answered under, if it is
+    an etagged view's for these same scopes, saving a lookup.
+    """
+    if flask.has_request_context():
+        tagged = flask.g.get('etag')
+        if tagged is not None and tagged[0] == tuple(scopes):
+            return tagged[1]
+    return None
+
+
+def served_stale(scopes, tag):
+    """
+    Note that the value being sent was built at the versions `tag` of
+    `scopes` (None if unknown) rather than at their current ones, so that
+    etagged() doesn't pin the current tag to it.
+    """
+    if flask.has_request_context():
+        flask.g.stale_etag = (tuple(scopes), tag)
+
+
+def etagged(scopes):
+    """
+    Give the decorated view a strong ETag made from the versions of
+    scopes(**view_args), answering a matching If-None-Match with a 304
+    before the view (and so the database or response cache) is touched.
+    Gzipped responses get their own ETag, as they are different bytes.
+
+    The view runs with use_primary(), as a replica may not yet show the
+    writes behind the versions in the tag, which would then be pinned to
+    stale data. The catalog snapshot is still used if it has caught up with
+    the last bump of the view's scopes (see request_marker). Views that
+    serve from the response cache only reach the database on a miss. If the cache serves an older value
+    (see served_stale), the response gets that value's tag instead, or no
+    ETag if it is unknown or for other scopes.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            view_scopes = tuple(scopes(**kwargs))
+            try:
+                tag, tag_marker = etag_and_marker(*view_scopes)
+            except redis.RedisError as e:
+                print(f'[versions]: failed to get versions: {e}')
+                return view(*args, **kwargs)
+            for matched in (tag, f'{tag}-gzip'):
+                if flask.request.if_none_match.contains(matched):
+                    response = flask.Response(status=304)
+                    response.set_etag(matched)
+                    response.vary.add('Accept-Encoding')
+                    return response
+            flask.g.etag = (view_scopes, tag)
+            flask.g.etag_marker = tag_marker
+            with use_primary():
+                response = flask.make_response(view(*args, **kwargs))
+            stale = flask.g.pop('stale_etag', None)
+            if stale is not None:
+                tag = stale[1] if stale[0] == view_scopes else None
+            if response.status_code == 200 and tag is not None:
+                gzipped = response.headers.get('Content-Encoding') == 'gzip'
+                response.set_etag(f'{tag}-gzip' if gzipped else tag)
+            return response
+        return wrapper
+    return decorator
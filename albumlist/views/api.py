@@ -1,11 +1,12 @@
-import csv
+import base64
 import flask
-import io
 import itertools
+import time
+from datetime import datetime
 
-from albumlist import constants
+from albumlist import cache, constants, delayed, versions
 from albumlist.delayed import queued
-from albumlist.models import DatabaseError
+from albumlist.models import DatabaseError, catalog, get_pool_stats
 from albumlist.models import albums as albums_model, list as list_model
 from albumlist.scrapers import bandcamp, links
 
@@ -22,7 +23,62 @@ def after_request(response):
     return response
 
 
+PAGE_ARGS = ('fields', 'limit', 'after')
+PAGE_LIMIT = 100
+PAGE_LIMIT_MAX = 1000
+AFTER_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_after(key):
+    added, album_id = key
+    return base64.urlsafe_b64encode(f'{added.strftime(AFTER_FORMAT)}|{album_id}'.encode()).decode()
+
+
+def decode_after(token):
+    added, album_id = base64.urlsafe_b64decode(token.encode()).decode().split('|', 1)
+    return datetime.strptime(added, AFTER_FORMAT), album_id
+
+
+def albums_page_response(channel=None, tag=None):
+    args = flask.request.args
+    fields = [field for field in args.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in albums_model.ALBUM_FIELDS]
+    if unknown:
+        return flask.jsonify({'text': f'unknown fields: {", ".join(unknown)}'}), 400
+    try:
+        limit = min(max(int(args.get('limit', PAGE_LIMIT)), 1), PAGE_LIMIT_MAX)
+        after = decode_after(args['after']) if args.get('after') else None
+    except ValueError:
+        return flask.jsonify({'text': 'invalid limit or after'}), 400
+
+    def build():
+        albums, next_after = albums_model.get_albums_page(fields, limit, after, channel=channel, tag=tag)
+        return {
+            'text': 'success',
+            'meta': {
+                'limit': limit,
+                'count': len(albums),
+                'next': encode_after(next_after) if next_after else None,
+            },
+            'albums': albums,
+        }
+
+    try:
+        scopes = [f'tag:{tag}'] if tag else albums_scopes()
+        return flask.current_app.response_cache.cached(build, scopes=scopes)
+    except DatabaseError as e:
+        print('[db]: failed to get albums page')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+
+
+def albums_scopes():
+    channel = flask.request.args.get('channel')
+    return [f'channel:{channel}'] if channel else ['albums']
+
+
 @api_blueprint.route('/list', methods=['GET'])
+@versions.etagged(lambda: ['list'])
 def api_list_albums():
     try:
         return flask.jsonify(list_model.get_list()), 200
@@ -33,9 +89,11 @@ def api_list_albums():
 
 
 @api_blueprint.route('/list/count', methods=['GET'])
+@versions.etagged(lambda: ['list'])
 def api_id_count():
     try:
-        return flask.jsonify({'count': list_model.get_list_count()}), 200
+        estimated = flask.request.args.get('estimated', '').lower() in ('1', 'true')
+        return flask.jsonify({'count': list_model.get_list_count(estimated=estimated)}), 200
     except DatabaseError as e:
         print('[db]: failed to get list count')
         print(f'[db]: {e}')
@@ -43,21 +101,14 @@ def api_id_count():
 
 
 @api_blueprint.route('/albums', methods=['GET'])
+@versions.etagged(albums_scopes)
 def api_list_album_details():
     channel = flask.request.args.get('channel')
-    if channel:
-        albums = albums_model.get_albums_by_channel_with_tags(channel)
-        key = f'api-albums-{channel}'
-    else:
-        albums = albums_model.get_albums_with_tags()
-        key = 'api-albums'
+    if any(arg in flask.request.args for arg in PAGE_ARGS):
+        return albums_page_response(channel=channel)
     try:
-        details = flask.current_app.cache.get(key)
-        if not details:
-            details = albums_model.Album.details_map_from_albums(albums)
-            details = [{key: d} for key, d in details.items()]
-            flask.current_app.cache.set(key, details, 60 * 5)
-        return flask.jsonify(details), 200
+        return flask.current_app.response_cache.cached(
+            lambda: albums_model.get_album_details_json(channel=channel), scopes=albums_scopes())
     except DatabaseError as e:
         print('[db]: failed to get albums')
         print(f'[db]: {e}')
@@ -65,9 +116,11 @@ def api_list_album_details():
 
 
 @api_blueprint.route('/albums/count', methods=['GET'])
+@versions.etagged(lambda: ['albums'])
 def api_count_albums():
     try:
-        return flask.jsonify({'count': albums_model.get_albums_count()}), 200
+        estimated = flask.request.args.get('estimated', '').lower() in ('1', 'true')
+        return flask.jsonify({'count': albums_model.get_albums_count(estimated=estimated)}), 200
     except DatabaseError as e:
         print('[db]: failed to get albums count')
         print(f'[db]: {e}')
@@ -75,29 +128,25 @@ def api_count_albums():
 
 
 @api_blueprint.route('/albums/dump', methods=['GET'])
+@versions.etagged(lambda: ['albums'])
 def api_dump_album_details():
-    # need StringIO for csv.writer
-    proxy = io.StringIO()
-    albums = albums_model.get_albums_with_users()
-    first_album = next(albums)
-    csv_writer = csv.DictWriter(proxy, fieldnames=first_album.fieldnames)
-    csv_writer.writeheader()
-    for album in itertools.chain([first_album], albums):
-        csv_writer.writerow(album.to_dict())
-    # and BytesIO for flask.send_file
-    mem = io.BytesIO()
-    mem.write(proxy.getvalue().encode('utf-8'))
-    mem.seek(0)
-    proxy.close()
-    # see: https://stackoverflow.com/a/45111660
-    return flask.send_file(mem,
-                           as_attachment=True,
-                           attachment_filename="albums.csv",
-                           mimetype='text/csv',
-                           cache_timeout=0 if flask.request.args.get('fresh') else None)
+    chunks = albums_model.stream_albums_csv()
+    try:
+        # pull the first chunk so that database errors can still become a 500
+        first_chunk = next(chunks, b'')
+    except DatabaseError as e:
+        print('[db]: failed to dump albums')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+    response = flask.Response(itertools.chain([first_chunk], chunks), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=albums.csv'
+    response.cache_control.public = True
+    response.cache_control.max_age = 0 if flask.request.args.get('fresh') else 60 * 60 * 12
+    return response
 
 
 @api_blueprint.route('/album/<album_id>', methods=['GET'])
+@versions.etagged(lambda album_id: [f'album:{album_id}'])
 def api_album(album_id):
     try:
         if flask.request.args.get('reviews'):
@@ -118,6 +167,7 @@ def api_album(album_id):
 
 
 @api_blueprint.route('/album/<album_id>/reviews', methods=['GET'])
+@versions.etagged(lambda album_id: [f'album:{album_id}'])
 def api_album_reviews(album_id):
     try:
         album = albums_model.get_album_details_with_reviews(album_id)
@@ -135,22 +185,53 @@ def api_album_reviews(album_id):
 
 
 @api_blueprint.route('/tags/<tag>', methods=['GET'])
+@versions.etagged(lambda tag: [f'tag:{tag}'])
 def api_album_by_tag(tag):
-    key = f'api-tags-{tag}'
+    if any(arg in flask.request.args for arg in PAGE_ARGS):
+        return albums_page_response(tag=tag)
     try:
-        details = flask.current_app.cache.get(key)
-        if not details:
-            albums = albums_model.get_albums_by_tag(tag)
-            details = albums_model.Album.details_map_from_albums(albums)
-            details = [{key: d} for key, d in details.items()]
-            flask.current_app.cache.set(key, details, 60 * 30)
-        return flask.jsonify(details), 200
+        return flask.current_app.response_cache.cached(
+            lambda: albums_model.get_album_details_json(tag=tag), scopes=[f'tag:{tag}'])
     except DatabaseError as e:
         print(f'[db]: failed to get tag: {tag}')
         print(f'[db]: {e}')
         return flask.jsonify({'text': 'failed'}), 500
 
 
+@api_blueprint.route('/search', methods=['GET'])
+def api_search():
+    query = flask.request.args.get('q', '').strip()
+    if not query:
+        return flask.jsonify({'text': 'missing query'}), 400
+    try:
+        limit = min(max(int(flask.request.args.get('limit', 20)), 1), 100)
+        offset = int(flask.request.args.get('offset', 0))
+        if offset < 0:
+            raise ValueError(offset)
+    except ValueError:
+        return flask.jsonify({'text': 'invalid limit or offset'}), 400
+    try:
+        started = time.perf_counter()
+        albums = list(albums_model.search_albums(query, limit=limit, offset=offset))
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+    except DatabaseError as e:
+        print(f'[db]: failed to search for: {query}')
+        print(f'[db]: {e}')
+        return flask.jsonify({'text': 'failed'}), 500
+    response = {
+        'text': 'success',
+        'meta': {
+            'query': query,
+            'limit': limit,
+            'offset': offset,
+            'count': len(albums),
+            'took_ms': took_ms,
+        },
+        'albums': [album.to_dict() for album in albums],
+    }
+    return flask.jsonify(response), 200
+
+
 @api_blueprint.route('/bc/<album_id>', methods=['GET'])
 def api_bc(album_id):
     return flask.redirect(constants.BANDCAMP_URL_TEMPLATE.format(album_id=album_id), code=302)
@@ -159,7 +240,8 @@ def api_bc(album_id):
 @api_blueprint.route('/albums/random', methods=['GET'])
 def api_random():
     try:
-        album = albums_model.get_random_album()
+        album = albums_model.get_random_album(tag=flask.request.args.get('tag'),
+                                              channel=flask.request.args.get('channel'))
         if album is None:
             return flask.jsonify({'text': 'not found'}), 404
         response = {
@@ -174,14 +256,11 @@ def api_random():
 
 
 @api_blueprint.route('/albums/available/urls', methods=['GET'])
+@versions.etagged(lambda: ['albums'])
 def available_urls():
     try:
-        key = 'api-albums-available-urls'
-        urls = flask.current_app.cache.get(key)
-        if not urls:
-            urls = [album.album_url for album in albums_model.get_albums_available()]
-            flask.current_app.cache.set(key, urls, 60 * 30)
-        return flask.jsonify(urls), 200
+        return flask.current_app.response_cache.cached(
+            lambda: [album.album_url for album in albums_model.get_albums_available()], scopes=['albums'])
     except DatabaseError as e:
         print('[db]: failed to get album urls')
         print(f'[db]: {e}')
@@ -189,6 +268,7 @@ def available_urls():
 
 
 @api_blueprint.route('/albums/unavailable/count', methods=['GET'])
+@versions.etagged(lambda: ['albums'])
 def unavailable_count():
     try:
         return flask.jsonify({'count': albums_model.get_albums_unavailable_count()}), 200
@@ -198,6 +278,26 @@ def unavailable_count():
         return flask.jsonify({'text': 'failed'}), 500
 
 
+@api_blueprint.route('/db/pool', methods=['GET'])
+def db_pool_stats():
+    return flask.jsonify(get_pool_stats()), 200
+
+
+@api_blueprint.route('/db/catalog', methods=['GET'])
+def db_catalog_stats():
+    return flask.jsonify(catalog.get_stats()), 200
+
+
+@api_blueprint.route('/queues', methods=['GET'])
+def queue_stats():
+    return flask.jsonify(delayed.get_lane_stats()), 200
+
+
+@api_blueprint.route('/cache/local', methods=['GET'])
+def local_cache_stats():
+    return flask.jsonify(cache.local_cache.get_stats()), 200
+
+
 @api_blueprint.route('/albums/scrape', methods=['POST'])
 def scrape_album():
     form_data = flask.request.form
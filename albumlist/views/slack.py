@@ -2,12 +2,13 @@ import functools
 import json
 import random
 import re
+import time
 
 import flask
 import requests
 import slacker
 
-from albumlist import constants
+from albumlist import cache, constants
 from albumlist.delayed import queued
 from albumlist.models import DatabaseError
 from albumlist.models import albums as albums_model, list as list_model
@@ -164,13 +165,13 @@ def add():
     album_id = form_data.get('text')
     if album_id:
         try:
-            list_model.add_to_list(album_id.strip())
+            added = list_model.add_to_list(album_id.strip())
         except DatabaseError as e:
             flask.current_app.logger.error('[db]: failed to add new album')
             flask.current_app.logger.error(f'[db]: {e}')
             return 'Failed to add new album', 200
         else:
-            return 'Added new album', 200
+            return ('Added new album' if added else 'Album already in list'), 200
     return '', 200
 
 
@@ -394,25 +395,47 @@ def build_bandcamp_search_response(album_details, max_attachments=None):
     }
 
 
+def cached_tag_search(tag):
+    def build():
+        albums = albums_model.search_albums_by_tag(tag)
+        return build_search_response(albums, slack_blueprint.config['LIST_NAME'],
+                                     slack_blueprint.config['SLACK_MAX_ATTACHMENTS'])
+    return cache.cached(flask.current_app.cache, f't-{tag}', build, scopes=[f'tag:{tag}'])
+
+
+def cached_user_albums(user):
+    def build():
+        albums = albums_model.get_albums_by_user(user)
+        response = build_search_response(albums, 'My List', slack_blueprint.config['SLACK_MAX_ATTACHMENTS'],
+                                         add_to_my_list=False,
+                                         remove_from_my_list=True)
+        response['attachments'] += build_my_list_attachment()
+        return response
+    return cache.cached(flask.current_app.cache, f'u-{user}', build, scopes=[f'user:{user}'])
+
+
 @slack_blueprint.route('/search', methods=['POST'])
 @slack_check
 def search():
     form_data = flask.request.form
     query = form_data.get('text').lower()
     if query:
-        response = flask.current_app.cache.get(f'q-{query}')
-        if not response:
-            try:
-                albums = albums_model.search_albums(query)
-            except DatabaseError as e:
-                flask.current_app.logger.error('[db]: failed to build album details')
-                flask.current_app.logger.error(f'[db]: {e}')
-                return 'failed to perform search', 500
-            else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                list_name = slack_blueprint.config['LIST_NAME']
-                response = build_search_response(albums, list_name, max_attachments)
-                flask.current_app.cache.set(f'q-{query}', response, 60 * 5)
+        def build():
+            albums = albums_model.search_albums(query)
+            max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
+            list_name = slack_blueprint.config['LIST_NAME']
+            return build_search_response(albums, list_name, max_attachments)
+
+        try:
+            started = time.perf_counter()
+            response = cache.cached(flask.current_app.cache, f'q-{query}', build, scopes=['albums'])
+            took_ms = round((time.perf_counter() - started) * 1000, 2)
+        except DatabaseError as e:
+            flask.current_app.logger.error('[db]: failed to build album details')
+            flask.current_app.logger.error(f'[db]: {e}')
+            return 'failed to perform search', 500
+        # timed per request, so kept out of the cached response (which may be shared)
+        response = dict(response, text=f'{response["text"]} ({took_ms}ms)')
         return flask.jsonify(response), 200
     return '', 200
 
@@ -442,19 +465,12 @@ def search_tags():
     form_data = flask.request.form
     query = form_data.get('text').lower()
     if query:
-        response = flask.current_app.cache.get(f't-{query}')
-        if not response:
-            try:
-                albums = albums_model.search_albums_by_tag(query)
-            except DatabaseError as e:
-                flask.current_app.logger.error('[db]: failed to build album details')
-                flask.current_app.logger.error(f'[db]: {e}')
-                return 'failed to perform search', 500
-            else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                list_name = slack_blueprint.config['LIST_NAME']
-                response = build_search_response(albums, list_name, max_attachments)
-                flask.current_app.cache.set(f't-{query}', response, 60 * 15)
+        try:
+            response = cached_tag_search(query)
+        except DatabaseError as e:
+            flask.current_app.logger.error('[db]: failed to build album details')
+            flask.current_app.logger.error(f'[db]: {e}')
+            return 'failed to perform search', 500
         return flask.jsonify(response), 200
     return '', 200
 
@@ -577,19 +593,12 @@ def handle_interactive_message(payload):
         flask.current_app.logger.debug(f'[access]: handling interactive message: {action["name"]}')
         if 'tag' in action['name']:
             query = action['value'].lower()
-            search_response = flask.current_app.cache.get(f't-{query}')
-            if not search_response:
-                try:
-                    albums = albums_model.search_albums_by_tag(query)
-                except DatabaseError as e:
-                    flask.current_app.logger.error('[db]: failed to build album details')
-                    flask.current_app.logger.error(f'[db]: {e}')
-                    return 'failed to perform search', 500
-                else:
-                    max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                    list_name = slack_blueprint.config['LIST_NAME']
-                    search_response = build_search_response(albums, list_name, max_attachments)
-                    flask.current_app.cache.set(f't-{query}', search_response, 60 * 5)
+            try:
+                search_response = cached_tag_search(query)
+            except DatabaseError as e:
+                flask.current_app.logger.error('[db]: failed to build album details')
+                flask.current_app.logger.error(f'[db]: {e}')
+                return 'failed to perform search', 500
             response = {
                 'response_type': 'ephemeral',
                 'text': f'Your #{query} results',
@@ -680,21 +689,12 @@ def handle_interactive_message(payload):
                                                               response_url=payload.get('response_url'))
         elif 'view_my_list' in action['name']:
             user = payload['user']['id']
-            response = flask.current_app.cache.get(f'u-{user}')
-            if not response:
-                try:
-                    albums = albums_model.get_albums_by_user(user)
-                except DatabaseError as e:
-                    flask.current_app.logger.error('[db]: failed to build album details')
-                    flask.current_app.logger.error(f'[db]: {e}')
-                    return 'failed to perform search', 500
-                else:
-                    response = build_search_response(albums, 'My List',
-                                                     max_attachments=slack_blueprint.config['SLACK_MAX_ATTACHMENTS'],
-                                                     add_to_my_list=False,
-                                                     remove_from_my_list=True)
-                    response['attachments'] += build_my_list_attachment()
-                    flask.current_app.cache.set(f'u-{user}', response, 5)
+            try:
+                response = cached_user_albums(user)
+            except DatabaseError as e:
+                flask.current_app.logger.error('[db]: failed to build album details')
+                flask.current_app.logger.error(f'[db]: {e}')
+                return 'failed to perform search', 500
             return flask.jsonify(response)
     except KeyError as missing_key:
         flask.current_app.logger.warn(f'[slack]: missing key in interactive payload: {missing_key}')
@@ -719,21 +719,12 @@ def restore_albums():
 def my_albums():
     user = flask.request.form.get('user_id')
     if user:
-        response = flask.current_app.cache.get(f'u-{user}')
-        if not response:
-            try:
-                albums = albums_model.get_albums_by_user(user)
-            except DatabaseError as e:
-                flask.current_app.logger.error('[db]: failed to build album details')
-                flask.current_app.logger.error(f'[db]: {e}')
-                return 'failed to perform search', 500
-            else:
-                max_attachments = slack_blueprint.config['SLACK_MAX_ATTACHMENTS']
-                response = build_search_response(albums, 'My List', max_attachments,
-                                                 add_to_my_list=False,
-                                                 remove_from_my_list=True)
-                response['attachments'] += build_my_list_attachment()
-                flask.current_app.cache.set(f'u-{user}', response, 5)
+        try:
+            response = cached_user_albums(user)
+        except DatabaseError as e:
+            flask.current_app.logger.error('[db]: failed to build album details')
+            flask.current_app.logger.error(f'[db]: {e}')
+            return 'failed to perform search', 500
         return flask.jsonify(response), 200
     return '', 200
 
@@ -0,0 +1,104 @@
+"""
+Measure the cost of turning catalog rows into API output.
+
+    REDIS_URL=redis://localhost python benchmarks/album_rows.py [rows]
+
+Builds Albums from synthetic get_albums_with_tags rows with the old
+dict-backed class (kept here as LegacyAlbum) and the slotted one, then
+serializes them the way /api/albums used to. If DATABASE_URL is set, it
+also times the real query against get_album_details_json, which builds
+the same JSON in Postgres without any per-album Python objects. Nothing
+is sent to Redis; it only needs to be configured for the import.
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from albumlist.models import albums as albums_model  # NOQA
+
+
+class LegacyAlbum:
+
+    def __init__(self, id, name, artist, url, img, available, channel, added, released, tags_json=None, users_json=None, reviews_json=None):
+        self.album_id = id
+        self.album_artist = artist
+        self.album_name = name
+        self.album_url = url
+        self.album_image = img
+        self.channel = channel
+        self.available = available
+        self.added = added
+        self.released = released
+        self.reviews = reviews_json
+        self.tags = tags_json
+        self.users = users_json
+
+    to_dict = albums_model.Album.to_dict
+
+    @classmethod
+    def from_values(cls, values):
+        try:
+            return cls(**values._asdict())
+        except AttributeError:
+            return cls(*values) if values else None
+
+    @classmethod
+    def albums_from_values(cls, list_of_values):
+        for values in list_of_values:
+            yield cls.from_values(values)
+
+
+def make_rows(count):
+    added = datetime(2017, 1, 1)
+    return [
+        (str(1000000000 + i), f'Album {i}', f'Artist {i % 5000}', f'https://artist{i % 5000}.bandcamp.com/album/album-{i}',
+         f'https://f4.bcbits.com/img/a{i}_16.jpg', True, 'general', added + timedelta(minutes=i), '01 January 2017',
+         ['ambient', 'electronic'])
+        for i in range(count)
+    ]
+
+
+DESCRIPTION = tuple((name, ) for name in albums_model.Album.COLUMNS[:10])
+
+
+def measure(name, f):
+    gc.collect()
+    started = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - started
+    # measure memory on a second run, as tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    result = f()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<36} {elapsed * 1000:8.1f} ms {retained / 2 ** 20:8.1f} MiB retained {peak / 2 ** 20:8.1f} MiB peak')
+    return result
+
+
+def details_json(albums):
+    details = albums_model.Album.details_map_from_albums(albums)
+    return json.dumps([{key: d} for key, d in details.items()])
+
+
+def main(count):
+    rows = make_rows(count)
+    print(f'{count} rows')
+    make_album = albums_model.Album.row_factory(DESCRIPTION)
+    legacy = measure('legacy: build albums', lambda: list(LegacyAlbum.albums_from_values(rows)))
+    slotted = measure('slotted: build albums', lambda: [make_album(values) for values in rows])
+    measure('legacy: albums -> json', lambda: details_json(legacy))
+    measure('slotted: albums -> json', lambda: details_json(slotted))
+    if os.environ.get('DATABASE_URL'):
+        measure('db: get_albums_with_tags -> json', lambda: details_json(albums_model.get_albums_with_tags()))
+        measure('db: get_album_details_json', albums_model.get_album_details_json)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
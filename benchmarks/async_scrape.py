@@ -0,0 +1,97 @@
+"""
+Measure scraping throughput of the thread and asyncio worker modes.
+
+    python benchmarks/async_scrape.py [pages] [latency_ms]
+
+Serves album pages from a local fake Bandcamp (each response delayed by
+`latency_ms`, as the real one is far away) and scrapes their covers with
+the blocking scraper from WORKER_CONCURRENCY threads, as thread workers
+do, and then with the async scraper through one Fetcher, as an async
+worker does.
+"""
+import asyncio
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from albumlist.scrapers import bandcamp, bandcamp_async  # NOQA
+
+
+ALBUM_PAGE = """<html><body>
+<div id="tralbumArt"><a class="popupImage" href="#"><img src="https://f4.bcbits.com/img/a{album}_16.jpg"></a></div>
+<div class="tralbum-credits"><meta itemprop="datePublished" content="20170101"></div>
+<a class="tag" href="#">ambient</a><a class="tag" href="#">electronic</a>
+{padding}
+</body></html>
+"""
+
+
+class FakeBandcamp(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def make_handler(latency):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = ALBUM_PAGE.format(album=self.path.rsplit('-', 1)[-1], padding='<p>...</p>' * 2000).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def measure(name, count, f):
+    started = time.perf_counter()
+    covers = f()
+    elapsed = time.perf_counter() - started
+    assert len(covers) == count and all(covers)
+    print(f'{name:<36} {elapsed:8.2f} s {count / elapsed:8.1f} pages/s')
+
+
+def scrape_threaded(urls, threads):
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(bandcamp.scrape_bandcamp_album_cover_url_from_url, urls))
+
+
+def scrape_async(urls, limit):
+
+    async def scrape():
+        async with bandcamp_async.Fetcher(limit=limit) as fetcher:
+            return await asyncio.gather(*(
+                bandcamp_async.scrape_bandcamp_album_cover_url_from_url(fetcher, url) for url in urls))
+
+    return asyncio.get_event_loop().run_until_complete(scrape())
+
+
+def main(count, latency):
+    server = FakeBandcamp(('127.0.0.1', 0), make_handler(latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = [f'http://127.0.0.1:{server.server_port}/album/album-{i}' for i in range(count)]
+    threads = int(os.environ.get('WORKER_CONCURRENCY', 4))
+    print(f'{count} pages, {latency * 1000:.0f} ms latency')
+    measure(f'threads: {threads} workers', count, lambda: scrape_threaded(urls, threads))
+    limit = bandcamp_async.MAX_IN_FLIGHT
+    measure(f'async: {limit} in flight', count, lambda: scrape_async(urls, limit))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1)
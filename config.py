@@ -15,6 +15,7 @@ class Config(object):
     LIST_NAME = os.environ.get('LIST_NAME', 'Albumlist')
     SLACK_MAX_ATTACHMENTS = int(os.environ.get('SLACK_MAX_ATTACHMENTS', 100))
     ALBUMLISTBOT_URL = os.environ.get('ALBUMLISTBOT_URL')
+    CATALOG_SNAPSHOT = bool(os.environ.get('CATALOG_SNAPSHOT'))
 
 
 class ProductionConfig(Config):
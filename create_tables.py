@@ -1,12 +1,9 @@
 from albumlist.models import DatabaseError
-from albumlist.models.albums import create_albums_table, create_albums_index
-from albumlist.models.list import create_list_table
+from albumlist.models.migrations import run_migrations
 
 
 if __name__ == '__main__':
     try:
-        create_list_table()
-        create_albums_table()
-        create_albums_index()
+        run_migrations()
     except DatabaseError as e:
-        print(f'[db]: ERROR - {e}')
\ No newline at end of file
+        print(f'[db]: ERROR - {e}')
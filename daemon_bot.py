@@ -1,8 +1,16 @@
 #!/usr/bin/env python
+import asyncio
+import multiprocessing
 import os
+import signal
+import threading
 import time
 import redis
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+from albumlist import delayed
+from albumlist.models import catalog
+from config import Config
 
 
 if 'REDIS_HOST' in os.environ:
@@ -10,36 +18,325 @@ if 'REDIS_HOST' in os.environ:
 else:
     redis_connection = redis.from_url(os.environ['REDIS_URL'])
 
+# how many tasks to run at once, in threads (most tasks wait on HTTP) or processes;
+# with WORKER_MODE=async, how many threads run blocking calls for the event loop
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 4))
+WORKER_MODE = os.environ.get('WORKER_MODE', 'thread')
+# how many tasks an async worker runs at once (their requests are bounded separately)
+WORKER_ASYNC_TASKS = int(os.environ.get('WORKER_ASYNC_TASKS', 500))
+# which lanes this daemon takes tasks from (e.g. a dyno of its own for interactive tasks)
+WORKER_LANES = os.environ.get('WORKER_LANES', ','.join(delayed.LANES)).split(',')
+# workers that only take interactive tasks, on top of WORKER_CONCURRENCY, so that
+# those never wait for a worker to finish a long batch from the other lanes
+WORKER_RESERVED_INTERACTIVE = int(os.environ.get('WORKER_RESERVED_INTERACTIVE', 1))
+# how long in-flight tasks get to finish after a SIGTERM (Heroku kills after 30s)
+DRAIN_TIMEOUT = float(os.environ.get('WORKER_DRAIN_TIMEOUT', 25))
+# an idle worker blocks on the queue for this long before checking for shutdown
+POLL_TIMEOUT = 1
+MAX_BACKOFF = 30
+# payloads that can't be run are kept here (the newest REJECTED_MAX of them) for inspection
+REJECTED_SUFFIX = ':rejected'
+REJECTED_MAX = 1000
+
+stopping = threading.Event()
+
+# pop from the first of KEYS that has anything, in one round trip
+POP_FIRST = redis_connection.register_script("""
+    for _, key in ipairs(KEYS) do
+        local value = redis.call('lpop', key)
+        if value then
+            return {key, value}
+        end
+    end
+    return false
+    """)
+
+QUEUE_LANES = {queue.encode(): lane for lane, queue in delayed.LANE_QUEUES.items()}
+# tasks queued before there were lanes
+QUEUE_LANES[Config.REDIS_QUEUE_KEY.encode()] = delayed.DEFAULT_LANE
+
+
+def shutdown(signum, frame):
+    print('[daemon]: draining...')
+    stopping.set()
+
+
+class LanePoller:
+    """
+    Pops tasks from the given lanes in smooth weighted round-robin order:
+    each pop tries the lane whose turn it is first and then the others by
+    priority, so that no lane starves and no worker idles while any lane
+    has work. When all are empty, it blocks on them for up to POLL_TIMEOUT.
+    """
+
+    def __init__(self, lanes):
+        unknown = set(lanes).difference(delayed.LANES)
+        if unknown or not lanes:
+            raise ValueError(f'unknown or no lanes: {", ".join(unknown)}')
+        self.lanes = [lane for lane in delayed.LANES if lane in lanes]
+        self.total_weight = sum(delayed.LANE_WEIGHTS[lane] for lane in self.lanes)
+        self.credit = dict.fromkeys(self.lanes, 0)
+        # the pre-lanes queue is drained last
+        self.by_priority = [delayed.LANE_QUEUES[lane] for lane in self.lanes] + [Config.REDIS_QUEUE_KEY]
+
+    def _next_lane(self):
+        for lane in self.lanes:
+            self.credit[lane] += delayed.LANE_WEIGHTS[lane]
+        lane = max(self.lanes, key=self.credit.get)
+        self.credit[lane] -= self.total_weight
+        return lane
+
+    def pop(self):
+        first = delayed.LANE_QUEUES[self._next_lane()]
+        msg = POP_FIRST(keys=[first] + [queue for queue in self.by_priority if queue != first])
+        if msg is None:
+            msg = redis_connection.blpop(self.by_priority, timeout=POLL_TIMEOUT)
+        return msg
+
+
+def record_wait(msg, task):
+    if task.queued_at is None:
+        return
+    try:
+        delayed.record_wait(QUEUE_LANES.get(msg[0], delayed.DEFAULT_LANE), max(time.time() - task.queued_at, 0))
+    except redis.RedisError as e:
+        print(f'[daemon]: failed to record wait: {e}')
+
+
+def load_task(msg):
+    queue, payload = msg
+    try:
+        return delayed.decode_task(payload)
+    except delayed.TaskError as e:
+        print(f'[daemon]: rejected task: {e}')
+        rejected = queue.decode() + REJECTED_SUFFIX
+        try:
+            pipe = redis_connection.pipeline(transaction=False)
+            pipe.lpush(rejected, payload)
+            pipe.ltrim(rejected, 0, REJECTED_MAX - 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f'[daemon]: failed to keep rejected task: {e}')
+
+
+def pop_task(poller):
+    """
+    Pop the next message and load its task, recording how long it waited,
+    for async workers to run in their popper thread, as all of it can block.
+    """
+    msg = poller.pop()
+    task = load_task(msg) if msg is not None else None
+    if task is not None:
+        record_wait(msg, task)
+    return msg, task
+
+
+def call_task(application, func, args, kwargs):
+    with application.app_context():
+        return func(*args, **kwargs)
+
+
+def store_result(key, rv, rv_ttl):
+    redis_connection.set(key, delayed.encode_result(rv), ex=rv_ttl)
+    print(f'[daemon]: stored return value at {key}')
+
+
+def run_task(application, name, msg, rv_ttl):
+    task = load_task(msg)
+    if task is None:
+        return
+    record_wait(msg, task)
+    func, key, args, kwargs, _ = task
+    try:
+        print(f'[daemon]: {name} calling {func.__name__}')
+        rv = call_task(application, func, args, kwargs)
+        print(f'[daemon]: {name} complete!')
+    except Exception as e:
+        print(f'[daemon]: {name} {e}')
+        rv = e
+    if rv is not None:
+        store_result(key, rv, rv_ttl)
 
-def queue_daemon(queue, rv_ttl=500):
+
+def worker(lanes, name, rv_ttl=500):
+    """
+    Run tasks from the lanes until shutdown, finishing the current one first.
+    Popping blocks while the lanes are empty, so busy lanes are drained
+    without pausing and idle ones cost no polling; Redis errors back off.
+    """
     from application import application
 
-    while 1:
-        print('[daemon]: waiting for instruction...')
-        msg = redis_connection.blpop(queue)
-        print('[daemon]: received!')
+    poller = LanePoller(lanes)
+    idle = False
+    backoff = 0
+    while not stopping.is_set():
         try:
-            func, key, args, kwargs = pickle.loads(msg[1])
-        except Exception as e:
-            try:
-                print(f'[daemon]: failed to unpickle {e}')
-            except (TypeError, IndexError):
-                pass
+            msg = poller.pop()
+        except redis.RedisError as e:
+            backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+            print(f'[daemon]: {name} failed to pop ({e}), retrying in {backoff}s')
+            stopping.wait(backoff)
+            continue
+        backoff = 0
+        if msg is None:
+            if not idle:
+                print(f'[daemon]: {name} waiting for instruction...')
+                idle = True
+            continue
+        idle = False
+        run_task(application, name, msg, rv_ttl)
+
+
+def process_worker(lanes, name):
+    worker(lanes, name)
+    # multiprocessing skips atexit in children, so flush buffered album updates here
+    from albumlist.models.albums import flush_album_updates
+    flush_album_updates()
+
+
+async def run_async_task(application, fetcher, task, rv_ttl):
+    func, key, args, kwargs, _ = task
+    loop = asyncio.get_event_loop()
+    try:
+        print(f'[daemon]: calling {func.__name__}')
+        if getattr(func, 'run_async', None) is not None:
+            rv = await func.run_async(fetcher, *args, **kwargs)
         else:
+            rv = await loop.run_in_executor(None, call_task, application, func, args, kwargs)
+        print(f'[daemon]: {func.__name__} complete!')
+    except Exception as e:
+        print(f'[daemon]: {func.__name__} {e}')
+        rv = e
+    if rv is not None:
+        await loop.run_in_executor(None, store_result, key, rv, rv_ttl)
+
+
+async def async_worker(lanes, rv_ttl=500):
+    """
+    Run up to WORKER_ASYNC_TASKS tasks at once on an event loop: tasks with
+    an async variant (see albumlist.delayed.async_variant) share one
+    Fetcher, and the rest run in the loop's executor threads.
+    """
+    from application import application
+    from albumlist.delayed import queued_async  # NOQA: registers the async variants
+    from albumlist.scrapers.bandcamp_async import Fetcher
+
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY))
+    # popping (and the Redis calls around it) blocks, so it gets a thread of its own
+    # rather than queueing behind tasks in the default executor
+    popper = ThreadPoolExecutor(max_workers=1)
+    poller = LanePoller(lanes)
+    slots = asyncio.Semaphore(WORKER_ASYNC_TASKS)
+    pending = set()
+
+    def done(future):
+        pending.discard(future)
+        slots.release()
+
+    idle = False
+    backoff = 0
+    async with Fetcher() as fetcher:
+        while not stopping.is_set():
+            await slots.acquire()
             try:
-                print(f'[daemon]: calling {func.__name__}')
-                with application.app_context():
-                    rv = func(*args, **kwargs)
-                    print('[daemon]: complete!')
-            except Exception as e:
-                print(f'[daemon]: {e}')
-                rv = e
-            if rv is not None:
-                redis_connection.set(key, pickle.dumps(rv))
-                redis_connection.expire(key, rv_ttl)
-                print(f'[daemon]: stored return value at {key}')
-        print('[daemon]: sleeping for a bit...')
-        time.sleep(0.25)
-
-
-queue_daemon('deferred_queue')
+                msg, task = await loop.run_in_executor(popper, pop_task, poller)
+            except redis.RedisError as e:
+                slots.release()
+                backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                print(f'[daemon]: failed to pop ({e}), retrying in {backoff}s')
+                await asyncio.sleep(backoff)
+                continue
+            backoff = 0
+            if task is None:
+                slots.release()
+                if msg is None and not idle:
+                    print('[daemon]: waiting for instruction...')
+                    idle = True
+                continue
+            idle = False
+            future = asyncio.ensure_future(run_async_task(application, fetcher, task, rv_ttl))
+            pending.add(future)
+            future.add_done_callback(done)
+        if pending:
+            print(f'[daemon]: waiting for {len(pending)} tasks...')
+            _, unfinished = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+            if unfinished:
+                print(f'[daemon]: {len(unfinished)} tasks did not finish in time')
+    popper.shutdown(wait=False)
+
+
+def start_workers(lanes, prefix, count, mode):
+    if mode == 'process':
+        workers = [multiprocessing.Process(target=process_worker, args=(lanes, f'{prefix}-{n}'), name=f'{prefix}-{n}',
+                                           daemon=True)
+                   for n in range(count)]
+    else:
+        workers = [threading.Thread(target=worker, args=(lanes, f'{prefix}-{n}'), name=f'{prefix}-{n}', daemon=True)
+                   for n in range(count)]
+    for w in workers:
+        w.start()
+    if workers:
+        print(f'[daemon]: started {len(workers)} {mode} workers on {", ".join(lanes)}')
+    return workers
+
+
+def drain_workers(workers, mode):
+    if mode == 'process':
+        for w in workers:
+            if w.is_alive():
+                os.kill(w.pid, signal.SIGTERM)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    for w in workers:
+        w.join(max(deadline - time.monotonic(), 0))
+        if w.is_alive():
+            print(f'[daemon]: {w.name} did not finish in time')
+
+
+def size_database_pool(threads):
+    """
+    Give each process a connection pool big enough for its `threads` (and
+    the album update buffer's flushes), unless DATABASE_POOL_SIZE is set,
+    in which case warn if it is smaller, as workers would then wait in
+    checkout and could time out. Pools are created on first use, after this.
+    """
+    needed = threads + 1
+    size = os.environ.get('DATABASE_POOL_SIZE')
+    if size is None:
+        os.environ['DATABASE_POOL_SIZE'] = str(max(needed, 5))
+    elif int(size) < needed:
+        print(f'[daemon]: DATABASE_POOL_SIZE={size} is less than the {needed} connections '
+              f'that {threads} worker threads may use at once')
+
+
+def queue_daemon(lanes):
+    if WORKER_MODE not in ('thread', 'process', 'async'):
+        raise SystemExit(f'[daemon]: unknown WORKER_MODE {WORKER_MODE}, expected thread, process or async')
+    reserved = WORKER_RESERVED_INTERACTIVE if 'interactive' in lanes and len(lanes) > 1 else 0
+    # each worker process has a pool of its own; threads (and async executors) share one
+    size_database_pool(1 if WORKER_MODE == 'process' else WORKER_CONCURRENCY + reserved)
+    if WORKER_MODE == 'async':
+        # blocking interactive tasks would otherwise queue in the loop's executor behind the rest
+        workers = start_workers(['interactive'], 'interactive', reserved, 'thread')
+        print(f'[daemon]: started async worker on {", ".join(lanes)}')
+        asyncio.get_event_loop().run_until_complete(async_worker(lanes))
+        drain_workers(workers, 'thread')
+        # exit via SystemExit so that atexit handlers (e.g. buffered album updates) still run
+        raise SystemExit(0)
+    workers = start_workers(lanes, 'worker', WORKER_CONCURRENCY, WORKER_MODE)
+    workers += start_workers(['interactive'], 'interactive', reserved, WORKER_MODE)
+
+    # signals are only handled in the main thread, so wait here in short joins
+    while not stopping.is_set() and any(w.is_alive() for w in workers):
+        for w in workers:
+            w.join(0.5)
+    drain_workers(workers, WORKER_MODE)
+    # exit via SystemExit so that atexit handlers (e.g. buffered album updates) still run
+    raise SystemExit(0)
+
+
+# tasks sweep the catalog in batches and should see their own writes, so workers
+# gain nothing from a snapshot but its memory and refresh queries
+catalog.disable()
+signal.signal(signal.SIGTERM, shutdown)
+queue_daemon(WORKER_LANES)
@@ -0,0 +1,26 @@
+import sys
+
+from albumlist.models import DatabaseError
+from albumlist.models.migrations import run_migrations, verify_indexes
+
+
+def verify():
+    failures = 0
+    for name, indexes in verify_indexes():
+        if indexes:
+            print(f'[db]: {name} uses {", ".join(indexes)}')
+        else:
+            failures += 1
+            print(f'[db]: {name} does NOT use an index')
+    return failures
+
+
+if __name__ == '__main__':
+    try:
+        if '--verify' in sys.argv:
+            sys.exit(1 if verify() else 0)
+        applied = run_migrations()
+        print(f'[db]: applied {len(applied)} migration(s)')
+    except DatabaseError as e:
+        print(f'[db]: ERROR - {e}')
+        sys.exit(1)
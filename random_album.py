@@ -17,7 +17,7 @@ def post_random_album():
         print('[random]: missing environment variables')
         return
     try:
-        album = albums_model.get_random_album()
+        album = albums_model.get_next_album_in_cycle('album-of-the-day')
         if album is None:
             print('[random]: no random album found')
             return